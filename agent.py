@@ -3,11 +3,12 @@ import random
 import os
 import logging
 import models
+import policy
 from utils.config import load_model_config
 import torch
 import copy
 from utils.vis import plot_grad_flow,count_parameters,timestamp
-from replay_buffer import ReplayMemory, ReplayBuffer
+from replay_buffer import ReplayMemory, ReplayBuffer, BucketedReplayBuffer
 from labml_helpers.schedule import Piecewise
 from torch.optim import lr_scheduler
 
@@ -27,8 +28,14 @@ device = torch.device("cpu")
 
 class DQAgent:
 
-    def __init__(self, model, lr,bs, replace_freq, n_nodes, n_features):
+    def __init__(self, model, lr,bs, replace_freq, n_nodes, n_features, max_edges=None, edge_encoder='mlp', node_buckets=None):
+        # with node_buckets, e.g. [10, 20, 50], one model learns from graphs of up to max(node_buckets) nodes
+        if node_buckets:
+            if edge_encoder != 'mlp':
+                raise ValueError("node_buckets needs the 'mlp' edge encoder, the dense one is sized for one n_nodes")
+            n_nodes = max(node_buckets)
         self.model_name = model
+        self.lr = lr
         self.gamma = .99  # 0.99
         self.epsilon_ = 0.95 #eps
         self.epsilon_min = 0.01 #0.05
@@ -37,6 +44,8 @@ class DQAgent:
 
         self.n_nodes = n_nodes 
         self.n_features = n_features
+        self.edge_encoder = edge_encoder
+        self.node_buckets = node_buckets
 
         self.target_net_replace_freq = replace_freq  # How frequently target netowrk updates
         # self.mem_capacity = 30000 # capacity of experience replay buffer ,100000
@@ -45,15 +54,7 @@ class DQAgent:
 
         # elif self.model_name == 'GCN_Naive':
         #      self.policy_net = models.GCN_Naive(c_in=8, c_out=1, c_hidden=8)
-        self.policy_net = models.GATv2(
-            in_features=self.n_features, 
-            n_hidden=128, 
-            n_classes=1, 
-            n_nodes=self.n_nodes, 
-            n_heads=1, 
-            dropout=0.0, 
-            share_weights=False).to(device)
-        self.target_net = copy.deepcopy(self.policy_net).to(device)
+        self.build_nets()
 
         # Define counter, memory size and loss function
         self.learn_step_counter = 0  # count the steps of learning process
@@ -69,18 +70,43 @@ class DQAgent:
             ], outside_value=1)
         self.prioritized_replay_alpha = 0.5
         # Replay buffer with α=0.6. Capacity of the replay buffer must be a power of 2.
-        self.replay_buffer = ReplayBuffer(self.mem_capacity, self.prioritized_replay_alpha, self.n_nodes, self.n_features)
+        # with max_edges, transitions keep the graph as an edge list, see Environment(sparse=True)
+        # with node_buckets, transitions are padded to the size of their bucket, see BucketedReplayBuffer
+        if node_buckets:
+            self.replay_buffer = BucketedReplayBuffer(self.mem_capacity, self.prioritized_replay_alpha, node_buckets, self.n_features, max_edges)
+        else:
+            self.replay_buffer = ReplayBuffer(self.mem_capacity, self.prioritized_replay_alpha, self.n_nodes, self.n_features, max_edges)
+
+        # ------Define the loss function-----#
+        self.criterion = torch.nn.SmoothL1Loss(reduction='none')
+
+    def build_nets(self):
+        """ Builds the policy and target networks and their optimizer for `self.edge_encoder`. """
+        # 'GATv2_encdec' encodes the graph once per episode, see choose_action
+        net = models.GATv2EncDec if self.model_name == 'GATv2_encdec' else models.GATv2
+        self.policy_net = net(
+            in_features=self.n_features, 
+            n_hidden=128, 
+            n_classes=1, 
+            n_nodes=self.n_nodes, 
+            n_heads=1, 
+            dropout=0.0, 
+            share_weights=False,
+            edge_encoder=self.edge_encoder).to(device)
+        self.target_net = copy.deepcopy(self.policy_net).to(device)
+        # the edge terms only depend on the graph, both networks share them
+        self.target_net.edge_cache = self.policy_net.edge_cache
+        self.embedding_key = None
+        self.inference_net = None # see compile_inference
 
         # ------- Define the optimizer------#
         # self.optimizer = torch.optim.Adam(self.policy_net.parameters(), lr=lr, weight_decay= 0.01)
         # self.optimizer = torch.optim.SGD(self.policy_net.parameters(), lr=lr, momentum= 0.9, weight_decay= 0.01)
-        self.optimizer = torch.optim.SGD(self.policy_net.parameters(), lr=lr, momentum= 0.9, weight_decay= 0.01)
+        self.optimizer = torch.optim.SGD(self.policy_net.parameters(), lr=self.lr, momentum= 0.9, weight_decay= 0.01)
         self.scheduler = lr_scheduler.ExponentialLR(self.optimizer, gamma=0.999)
 
-        # ------Define the loss function-----#
-        self.criterion = torch.nn.SmoothL1Loss(reduction='none')
-
-    def choose_action(self, state, adj, mask):
+    def choose_action(self, state, adj, mask, graph_id=None):
+        # `graph_id` is the key of the graph of `adj`, to reuse its cached edge terms
         pr = torch.rand(1)
 
         if self.epsilon_ > pr:
@@ -88,11 +114,83 @@ class DQAgent:
             q_a = None
             action = torch.tensor([np.random.choice(np.where(mask[0] == 1)[0])]) # randomly choose any unvisited node + depot
         else:
-            q_a = self.policy_net(state.T.unsqueeze(0), adj.unsqueeze(0), mask=None).detach().clone().to(device)
+            x, adj = state.T.unsqueeze(0), models.add_batch_dim(adj)
+            # a state padded beyond its mask: the padded nodes are masked out and never chosen
+            node_mask = None
+            if mask.shape[-1] < x.shape[1]:
+                node_mask = models.padding_mask([mask.shape[-1]], x.shape[1])
+                mask = torch.nn.functional.pad(mask, (0, x.shape[1] - mask.shape[-1]))
+            inference_net = self.inference_for(adj, x.shape[1]) if node_mask is None else None
+            if isinstance(self.acting_net(), models.GATv2EncDec) and graph_id is not None:
+                with torch.no_grad():
+                    q_a = self.acting_net().decode(x, self.node_embedding(x, adj, graph_id), node_mask).to(device)
+            elif inference_net is not None:
+                with torch.no_grad():
+                    q_a = torch.as_tensor(inference_net(x, adj)).to(device)
+            else:
+                graph_ids = None if graph_id is None else [graph_id]
+                q_a = self.policy_net(x, adj, mask=None, graph_ids=graph_ids, node_mask=node_mask).detach().clone().to(device)
             action = torch.argmax(q_a[0,:,0] + (1 - mask) * self.neg_inf).reshape(1)
 
         return action.to(device), q_a
 
+    def choose_actions(self, states, adj, masks, graph_ids=None, n_nodes=None):
+        """
+        Epsilon-greedy actions of a batch of environments, with one forward
+        for all the greedy ones. `states` are `[B, n_features, n_nodes]`,
+        `adj` a `[B, n_nodes, n_nodes]` batch or a batched (edge_index,
+        edge_weight) pair and `masks` `[B, n_nodes]`. `graph_ids` are the
+        graph keys, to reuse their cached edge terms, and `n_nodes` the
+        node counts of graphs padded to `n_nodes` columns. Returns the
+        `[B]` actions; a greedy row gets the action of `choose_action`.
+        """
+        masks = masks.reshape(len(states), -1).to(device)
+        actions = torch.multinomial(masks.float(), 1).squeeze(1) # uniform over the unmasked nodes
+        greedy = (torch.rand(len(states)) >= self.epsilon_).nonzero().squeeze(1)
+        if len(greedy) == 0:
+            return actions
+
+        x = states[greedy].transpose(1, 2)
+        adj = tuple(t[greedy] for t in adj) if isinstance(adj, tuple) else adj[greedy]
+        node_mask = None if n_nodes is None else models.padding_mask(torch.as_tensor(n_nodes)[greedy], x.shape[1])
+        graph_ids = None if graph_ids is None else [int(g) for g in np.asarray(graph_ids)[greedy.numpy()]]
+        inference_net = self.inference_for(adj, x.shape[1]) if node_mask is None else None
+        with torch.no_grad():
+            if inference_net is not None:
+                q = torch.as_tensor(inference_net(x, adj)).to(device)
+            else:
+                q = self.policy_net(x, adj, mask=None, graph_ids=graph_ids, node_mask=node_mask).to(device)
+        actions[greedy] = torch.argmax(q[:, :, 0] + (1 - masks[greedy]) * self.neg_inf, dim=1)
+        return actions
+
+    def inference_for(self, adj, n_nodes):
+        """ The inference net for a batch `adj` of graphs of `n_nodes` nodes, None to use the policy network. """
+        if self.inference_net is None:
+            return None
+        # a TorchScript trace or an OnnxPolicy only takes dense graphs
+        dense_only = isinstance(self.inference_net, torch.jit.ScriptModule) or getattr(self.inference_net, 'dense_only', False)
+        if dense_only and isinstance(adj, tuple):
+            return None
+        if isinstance(self.inference_net, torch.jit.ScriptModule):
+            # a trace is only valid for the n_nodes it was traced at, one is kept per size
+            if n_nodes not in self.traces:
+                self.traces[n_nodes] = policy.compile_policy(self.policy_net, n_nodes, self.trace_dir)
+            return self.traces[n_nodes]
+        return self.inference_net
+
+    def acting_net(self):
+        """ The network choose_action uses: the inference copy when there is one, else the policy network. """
+        return self.policy_net if self.inference_net is None else self.inference_net
+
+    def node_embedding(self, x, adj, graph_id):
+        """ Encoder output for graph `graph_id`, computed again when the graph or the weights change. """
+        key = (graph_id, self.learn_step_counter, id(self.acting_net()))
+        if self.embedding_key != key:
+            with torch.no_grad():
+                self.embedding = self.acting_net().encode(x, adj, graph_ids=[graph_id])
+            self.embedding_key = key
+        return self.embedding
+
     def learn(self,iter_count):
         # sampling batch of experiences, update parameters of target network
 
@@ -101,6 +199,7 @@ class DQAgent:
             # Assign the parameters of eval_net to target_net
             self.target_net.load_state_dict(self.policy_net.state_dict())
         self.learn_step_counter += 1
+        self.inference_net = None # traced or quantized with the weights before this step
 
         # Determine the Sampled batch from buffer
         # transitions = self.memory.sample(self.batch_size)
@@ -112,18 +211,27 @@ class DQAgent:
         b_a = torch.tensor(transitions['action']).reshape(self.batch_size,1)
         b_r = torch.tensor(transitions['reward']).reshape(self.batch_size,1)
         b_s_ = torch.tensor(transitions['next_obs']).permute(0,2,1).float().to(device)
-        b_adj = torch.tensor(transitions['adj']).float().to(device)
+        if 'adj' in transitions:
+            b_adj = torch.tensor(transitions['adj']).float().to(device)
+        else:
+            b_adj = (torch.tensor(transitions['edge_index']).long().to(device), torch.tensor(transitions['edge_weight']).float().to(device))
         b_weight = torch.tensor(transitions['weights']).reshape(self.batch_size,1,1).float().to(device)
+        # transitions added without a graph key (-1) do not use the edge term cache
+        b_graph = transitions['graph'] if (transitions['graph'] >= 0).all() else None
+        # graphs smaller than the buffer slots are zero padded, their padding is masked out of the Q-values
+        b_nodes = transitions['n_nodes']
+        b_node_mask = None if (b_nodes == b_s.shape[1]).all() else models.padding_mask(b_nodes, b_s.shape[1]).to(device)
 
-        # calculate the Q value of state-action pair
+        # calculate the Q value of state-action pair, one policy forward gives q_eval and the double-DQN action
         a_idx = b_a.unsqueeze(-1)
-        q_eval = self.policy_net(b_s,b_adj,mask = None).gather(1, a_idx)
+        q_all = self.policy_net(b_s,b_adj,mask = None, graph_ids=b_graph, node_mask=b_node_mask)
+        q_eval = q_all.gather(1, a_idx)
 
         # double-DQN
         with torch.no_grad():
             # select the maximum q value
-            best_a = self.policy_net(b_s, b_adj, mask = None).argmax(1).unsqueeze(-1)
-            best_q_next = self.target_net(b_s_, b_adj, mask = None).gather(1, best_a).to(device)
+            best_a = q_all.detach().argmax(1).unsqueeze(-1)
+            best_q_next = self.target_net(b_s_, b_adj, mask = None, graph_ids=b_graph, node_mask=b_node_mask).gather(1, best_a).to(device)
 
             b_r = torch.clamp(b_r, min=-1, max=1).to(device) # reward clipped within [−1, 1] for stability
             q_target = (b_r.unsqueeze(-1) + self.gamma * best_q_next).float().to(device)  # (batch_size, 1)
@@ -140,7 +248,7 @@ class DQAgent:
         loss = torch.clamp(loss, min=-1, max=1) # TD error clipped within [−1, 1] for stability
 
         # Calculate priorities for replay buffer
-        new_priorities = np.abs(td_errors.cpu().numpy()) + 1e-6
+        new_priorities = np.abs(td_errors.cpu().numpy()).reshape(-1) + 1e-6 # one scalar per transition
 
         # Update replay buffer priorities
         self.replay_buffer.update_priorities(transitions['indexes'], new_priorities)
@@ -149,7 +257,7 @@ class DQAgent:
 
         self.optimizer.zero_grad()  # reset the gradient to zero
 
-        loss.backward(retain_graph=True)
+        loss.backward() # frees the saved activations, nothing runs backward through this graph again
 
         # torch.nn.utils.clip_grad.clip_grad_norm_(self.policy_net.parameters(), 10)
         # for param in self.policy_net.parameters():
@@ -163,12 +271,63 @@ class DQAgent:
 
         return loss, self.epsilon_
 
+    def clear_edge_cache(self):
+        """ Forgets the cached edge terms and node embedding, needed before graph keys refer to other graphs, e.g. a new graph_dict. """
+        if self.policy_net.edge_cache is not None:
+            self.policy_net.edge_cache.clear()
+        self.embedding_key = None
+
     def save_model(self):
         cwd = os.getcwd()
         torch.save(self.policy_net.state_dict(), cwd + '/trained_models/model_{}.pt'.format(timestamp()))
 
-    def load_model(self, model_path):
-        self.policy_net.load_state_dict(torch.load(model_path))
+    def load_model(self, model_path, quantize=False, min_agreement=policy.MIN_AGREEMENT):
+        """
+        Loads the weights of the policy network. With `quantize`, actions
+        are chosen by an int8 copy of it, see `policy.quantize_policy`, if
+        it picks the same greedy node as the float network on at least
+        `min_agreement` of random states; otherwise a warning is logged and
+        the float network is kept. `learn` drops the int8 copy, so after
+        the first learning step actions are float again: quantize for
+        validation only, or call `load_model` again.
+        """
+        state_dict = torch.load(model_path)
+        # checkpoints with lin_n_node weights were trained with the dense edge encoder, for one n_nodes
+        edge_encoder = 'dense' if any('lin_n_node' in k for k in state_dict) else 'mlp'
+        if edge_encoder != self.edge_encoder:
+            logging.info('{} uses the {} edge encoder, rebuilding the networks'.format(model_path, edge_encoder))
+            self.edge_encoder = edge_encoder
+            self.build_nets()
+        self.policy_net.load_state_dict(state_dict)
+        self.embedding_key = None
+        self.inference_net = None
+        if quantize:
+            quantized = policy.quantize_policy(self.policy_net)
+            agreement = policy.action_agreement(self.policy_net, quantized, self.n_nodes)
+            if agreement >= min_agreement:
+                self.inference_net = quantized
+            else:
+                logging.warning('int8 policy picks the float greedy node on {:.1%} of random states (< {:.0%}), '
+                                'acting with the float network'.format(agreement, min_agreement))
+
+    def use_onnx(self, path, **session_kwargs):
+        """
+        Chooses actions with an ONNX export of the policy network run by
+        onnxruntime, see `onnx_policy.OnnxPolicy`, until the next `learn`.
+        """
+        from onnx_policy import OnnxPolicy
+        self.inference_net = OnnxPolicy(path, **session_kwargs)
+
+    def compile_inference(self, cache_dir=policy.CACHE_DIR):
+        """
+        Uses a TorchScript trace of the policy network in `choose_action`
+        for dense graphs, see `policy.compile_policy`. Graphs of another
+        size get their own trace, made on first use. Traces are dropped at
+        the next `learn` or `load_model`, so compile after loading a model.
+        """
+        self.trace_dir = cache_dir
+        self.inference_net = policy.compile_policy(self.policy_net, self.n_nodes, cache_dir)
+        self.traces = {self.n_nodes: self.inference_net}
 
     def cuda(self):
         self.policy_net = self.policy_net.cuda()
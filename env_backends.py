@@ -0,0 +1,154 @@
+import types
+
+try:
+    import numba
+except ImportError:
+    numba = None
+"""
+Transition logic of the BSSrp environment as pure functions over flat
+NumPy arrays: load/demand update, reward terms, overage, the dynamic
+feature update, the observation and the action mask.
+
+The same functions back two interchangeable backends: `numba` compiles
+them with `numba.njit` and `numpy` runs them as plain NumPy. `Environment`
+picks one with its `backend` argument; torch tensors only appear at the
+observation boundary.
+"""
+
+
+def new_load_demand(load, demand, max_load):
+    """ Gets the vehicle load and the demand left at a station after serving it. """
+    new_load = min(max(load + demand, 0.), max_load)
+    load_diff = new_load - load
+    return new_load, demand - load_diff
+
+
+def overage_time(route_time, travel, time_limit):
+    """ Gets the overage time for a move of `travel` minutes on a trip of `route_time` minutes. """
+    if route_time > time_limit:
+        return travel
+    elif route_time + travel > time_limit:
+        return route_time + travel - time_limit
+    return 0.
+
+
+def overage_last_step(route_time, travel, to_depot, time_limit):
+    """ Gets the overage time for moving to the depot in the last step. """
+    dist_to_idx = route_time + travel
+    dist_to_depot = route_time + travel + to_depot
+    if dist_to_idx > time_limit:
+        return to_depot
+    elif dist_to_depot > time_limit:
+        return dist_to_depot - time_limit
+    return 0.
+
+
+def reward_terms(travel, unmet_demand, overage, penalty_cost_demand, penalty_cost_time):
+    """ Gets the tour, demand and overage terms of a reward. """
+    return travel, unmet_demand * penalty_cost_demand, overage * penalty_cost_time
+
+
+def update_dynamic(dynamic, chosen_idx, prev_idx, new_load, new_demand, trip_over, travel, car_step):
+    """ Updates the dynamic features in place after moving from `prev_idx` to `chosen_idx`. """
+    if chosen_idx != 0:
+        dynamic[0, chosen_idx] = 1
+    dynamic[1, chosen_idx] = new_load
+    dynamic[2, chosen_idx] = new_demand
+    dynamic[3, :] = 0  # current node
+    dynamic[3, chosen_idx] = 1
+    dynamic[4, :] = 0  # previous node
+    dynamic[4, prev_idx] = 1
+
+    if prev_idx == 0:
+        dynamic[6, :] = 0  # trip overage reset
+    else:
+        dynamic[6, chosen_idx] = trip_over  # normalized trip overtime
+
+    if chosen_idx == 0:  # return to depot
+        dynamic[5, :] = 0  # zero trip time
+        dynamic[7, :] += car_step  # normalized car overage
+    else:
+        dynamic[5, chosen_idx] = travel
+
+
+def compute_state(state, dynamic, chosen_idx):
+    """ Writes the visited, demand, load, trip time and trip overage rows of the observation. """
+    state[0, :] = dynamic[0]
+    state[1, :] = dynamic[2]
+    state[2, :] = dynamic[1, chosen_idx]
+    state[3, :] = dynamic[5, chosen_idx]
+    state[4, :] = dynamic[6, chosen_idx]
+
+
+def compute_mask(mask, state, visited, via_depot_row, chosen_idx, last_node, max_load,
+                 check_time, cur_trip_len, max_trip_len, last_trip):
+    """
+    Writes the feasible next nodes into `mask`.
+
+    `state` is the observation before the step, `visited` the visited flags
+    after it and `via_depot_row` is `via_depot[chosen_idx]`.
+    """
+    # row 2 of the state is the load broadcast over all nodes, so the
+    # underload/overload tests hold either for every node or for none
+    cur_load = state[1, last_node]
+    underload = cur_load == 0 and state[2, 0] < 0
+    overload = cur_load == max_load and state[2, 0] > 0
+
+    mask[:] = state[0] == 0  # uncovered nodes
+    if underload or overload:
+        mask[:] = 0
+    mask[last_node] = 0
+    mask[0] = 1  # depot is always available unless last visit
+    mask[chosen_idx] = 0  # mask out visited node
+
+    if state[0].min() == 1 or not mask.any():
+        # all nodes are visited or no node to go, then go back to depot
+        mask[:] = 0
+        mask[0] = 1
+
+    # check if we should return to depot
+    if check_time:
+        candidates = mask[1:] != 0
+        candidates[chosen_idx - 1] = False
+        # via_depot_row[i] = time to visit i and then return to the depot
+        too_far = cur_trip_len + via_depot_row[1:] > max_trip_len
+        stations = mask[1:]
+        stations[candidates & too_far] = 0
+        if (candidates & ~too_far).any():  # mask depot if there are good nodes to visit
+            mask[0] = 0
+
+    # force to visit rest of nodes on last route
+    if last_trip:
+        if not mask[1:].any():  # if no options except depot
+            for i in range(mask.shape[0]):
+                mask[i] = 1 - visited[i]  # unmask all unvisited nodes
+        mask[0] = 0  # mask depot to ensure visitable
+
+
+KERNELS = (new_load_demand, overage_time, overage_last_step, reward_terms,
+           update_dynamic, compute_state, compute_mask)
+
+_backends = {}
+
+
+def get_backend(name='auto'):
+    """
+    Gets the transition kernels of a backend: `numba`, `numpy`, or `auto`
+    for numba when it is installed and numpy otherwise.
+    """
+    if name == 'auto':
+        name = 'numpy' if numba is None else 'numba'
+    if name in _backends:
+        return _backends[name]
+
+    if name == 'numpy':
+        kernels = {f.__name__: f for f in KERNELS}
+    elif name == 'numba':
+        if numba is None:
+            raise ImportError('the numba backend requires numba to be installed')
+        kernels = {f.__name__: numba.njit(cache=True)(f) for f in KERNELS}
+    else:
+        raise ValueError('unknown backend {}'.format(name))
+
+    _backends[name] = types.SimpleNamespace(name=name, **kernels)
+    return _backends[name]
@@ -2,6 +2,7 @@ import numpy as np
 import torch
 import matplotlib.pyplot as plt
 from utils.vis import timestamp
+from env_backends import get_backend
 """
 This file contains the definition of the environment
 in which the agents are run.
@@ -19,8 +20,26 @@ TRIP_OVER = 6
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 device = torch.device("cpu")
 
+
+def snapshot_dtype(n_nodes):
+    """ Structured dtype of an `Environment.snapshot()` for graphs of `n_nodes` nodes. """
+    return np.dtype([
+        ('games', np.int64),
+        ('prev_node', np.int32),
+        ('trip_count', np.int32),
+        ('tour_len', np.int32),
+        ('t_total', np.float64),
+        ('trip_time', np.float64),
+        ('ep_reward', np.float64, 4), # tour, demand, overage, car
+        ('dynamic', np.float32, (8, n_nodes)),
+        ('state', np.float32, (5, n_nodes)), # dynamic rows of the last observation
+        ('mask', np.int8, n_nodes),
+        ('tour', np.int16, 2 * n_nodes + 2), # a tour never visits the depot twice in a row
+    ])
+
+
 class Environment:
-    def __init__(self, graph_dict, name, verbose=True, reward_scale=500, penalty_unvisited=None, force_n_vehicles=True, overage_percent=0.05):
+    def __init__(self, graph_dict, name, verbose=True, reward_scale=500, penalty_unvisited=None, force_n_vehicles=True, overage_percent=0.05, inplace=False, backend='auto', sparse=False):
         self.graph_dict = graph_dict
         self.name = name
         self.verbose = verbose
@@ -29,24 +48,56 @@ class Environment:
         self.force_n_vehicles = force_n_vehicles
         self.overage_percent = overage_percent
 
+        # with inplace=True, state, mask and reward are returned as views of buffers
+        # allocated at reset() and overwritten by the next steps (a state stays valid
+        # for one more step). Use step(action, copy=True) to keep them around.
+        self.inplace = inplace
+        self._n_buf = None
+
+        # transition kernels, see env_backends
+        self.backend = get_backend(backend)
+
+        # with sparse=True, reset() returns the graph as (edge_index, edge_weight) instead of W_weighted
+        self.sparse = sparse
+
+    def __getstate__(self):
+        # NumPy views of the tensor buffers and the compiled kernels are rebuilt on unpickling
+        state = self.__dict__.copy()
+        for name in ('_dyn', '_state_np', '_mask_np', '_state_cur'):
+            state.pop(name, None)
+        state['backend'] = self.backend.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.backend = get_backend(self.backend)
+        if 'dynamic' in state:
+            self._dyn = self.dynamic.numpy()
+        if self._n_buf is not None:
+            self._state_np = self._state_buf.numpy()
+            self._mask_np = self._mask_buf.numpy()
+            self._state_cur = self._state_np[1 - self._state_idx]
+
     def reset(self, g):
         """ Reset graph per game input. """
         self.games = g
         self.graph = self.graph_dict[self.games]
-        self.dynamic = self.graph.dynamic.detach().clone()
+        self.dynamic = self.graph.dynamic.detach().clone().float()
         self.dynamic_init = self.dynamic.detach().clone()
+        self._dyn = self.dynamic.numpy() # shares memory with dynamic, used for scalar updates
         self.static = self.graph.static.detach()
-        self.emb = self.graph.emb.detach()
+        self.alloc_buffers()
         self.state = self.compute_state(0)
         self.prev_node = 0
         self.t_total = 0.
+        self.trip_time = 0.
         self.tour_indices = [0]
         self.prev_demand = np.abs(self.dynamic[2, 1:]).sum()
         self.mask = self.mask_reset()
 
         # 
-        self.dynamic[1][0] = self.graph.num_start
-        self.dynamic[7, :] = 1 / self.graph.n_vehicles
+        self._dyn[1, 0] = self.graph.num_start
+        self._dyn[7, :] = 1 / self.graph.n_vehicles
         if self.penalty_unvisited is None:
             self.penalty_unvisited = self.graph.penalty_cost_demand
 
@@ -56,13 +107,82 @@ class Environment:
         self.ep_reward_overage = 0
         self.ep_reward_car = 0
 
-        return self.state, self.graph.W_weighted, self.mask
+        return self._out(self.state), self.adj(), self._out(self.mask)
+
+    def adj(self):
+        """ Graph of the current game, dense or as an edge list depending on `sparse`. """
+        if self.sparse:
+            return self.graph.edge_index, self.graph.edge_weight
+        return self.graph.W_weighted
+
+    def alloc_buffers(self):
+        """ Allocates the state, mask and reward buffers, reused while the graph size does not change. """
+        n_nodes = self.graph.n_nodes
+        if self._n_buf != n_nodes:
+            self._n_buf = n_nodes
+            self._state_buf = torch.zeros(2, 7, n_nodes) # double buffered
+            self._mask_buf = torch.zeros(1, n_nodes, dtype=torch.int)
+            self._reward_buf = torch.zeros(1)
+            self._state_np = self._state_buf.numpy()
+            self._mask_np = self._mask_buf.numpy()
+        self._state_np[:, 5:] = (self.static.T / self.graph.area).numpy()
+        self._state_idx = 0
+
+    def _out(self, buf, copy=False):
+        """ Returns a buffer as is in inplace mode, a copy of it otherwise. """
+        if self.inplace and not copy:
+            return buf
+        return buf.clone()
 
     def mask_reset(self):
         """ Reset mask, exclude only depot node at the init. """
-        mask = torch.ones_like(self.dynamic[0]).unsqueeze(0).int()
-        mask[:,0] = 0
-        return mask
+        self._mask_np[:] = 1
+        self._mask_np[:, 0] = 0
+        return self._mask_buf
+
+    def snapshot(self, out=None):
+        """
+        Copies the per-episode state into a structured record of `snapshot_dtype`,
+        or into `out`, e.g. one element of a preallocated array of snapshots.
+        The graph is not copied, only its key.
+        """
+        if out is None:
+            out = np.zeros((), dtype=snapshot_dtype(self.graph.n_nodes))
+        out['games'] = self.games
+        out['prev_node'] = self.prev_node
+        out['trip_count'] = self.trip_count
+        out['tour_len'] = len(self.tour_indices)
+        out['t_total'] = self.t_total
+        out['trip_time'] = self.trip_time
+        out['ep_reward'] = (self.ep_reward_tour, self.ep_reward_demand, self.ep_reward_overage, self.ep_reward_car)
+        out['dynamic'] = self._dyn
+        out['state'] = self._state_cur[:5]
+        out['mask'] = self._mask_np[0]
+        out['tour'][:len(self.tour_indices)] = self.tour_indices
+        return out
+
+    def restore(self, token):
+        """ Restores the per-episode state saved by `snapshot()`. """
+        if getattr(self, 'games', None) != token['games']:
+            self.reset(token['games'].item())
+        self.prev_node = token['prev_node'].item()
+        self.trip_count = token['trip_count'].item()
+        self.t_total = token['t_total'].item()
+        self.trip_time = token['trip_time'].item()
+        self.ep_reward_tour, self.ep_reward_demand, self.ep_reward_overage, self.ep_reward_car = token['ep_reward'].tolist()
+        self.tour_indices = token['tour'][:token['tour_len']].tolist()
+        self._dyn[:] = token['dynamic']
+        self._mask_np[0] = token['mask']
+        self.mask = self._mask_buf
+
+        # restored observation goes in the next free state buffer, as in compute_state
+        state = self._state_np[self._state_idx]
+        state[:5] = token['state']
+        self._state_cur = state
+        self.state = self._state_buf[self._state_idx]
+        self._state_idx = 1 - self._state_idx
+
+        return self._out(self.state), self.adj(), self._out(self.mask)
 
     def compute_state(self, chosen_idx):
         """ Combine graph dynamic feature and static coordinate location. """
@@ -70,19 +190,15 @@ class Environment:
         #state = torch.cat((self.dynamic, self.static.T/self.graph.area, self.emb.T), dim=0)
         # state = torch.cat((self.dynamic, node_dist,self.emb.T), dim=0)
 
-        t_shape = (1, self.graph.n_nodes)
-
-        visited = self.dynamic[0].reshape(t_shape)
-        demand = self.dynamic[2].reshape(t_shape)
-        load = torch.ones(t_shape) * self.dynamic[1][chosen_idx]
-        trip_time = torch.ones(t_shape) * self.dynamic[5][chosen_idx]
-        trip_over = torch.ones(t_shape) * self.dynamic[6][chosen_idx]
-        pos = self.static.T/self.graph.area
-
-        state = torch.cat((visited, demand, load, trip_time, trip_over, pos))
+        # rows: visited, demand, load, trip_time, trip_over, pos (x, y), written into the next free buffer
+        state = self._state_np[self._state_idx]
+        self.backend.compute_state(state, self._dyn, chosen_idx)
 
         # state = torch.cat((self.dynamic,self.static.T),dim=0)
-        return state.float()
+        self._state_cur = state
+        state = self._state_buf[self._state_idx]
+        self._state_idx = 1 - self._state_idx
+        return state
 
     # def demand_reset(self):
     #     """ Reset demand per input graph. """
@@ -94,29 +210,19 @@ class Environment:
 
     def update_dynamic(self, chosen_idx, prev_idx, new_load, new_demand):
         # Updates the dynamic(observation, load, demand)
-        if not chosen_idx == 0:
-            self.dynamic[0, chosen_idx] = 1
-        self.dynamic[1, chosen_idx] = new_load
-        self.dynamic[2, chosen_idx] = new_demand
-        self.dynamic[3, :] = 0  # current node
-        self.dynamic[3, chosen_idx] = 1
-        self.dynamic[4, :] = 0  # previous node
-        self.dynamic[4, prev_idx] = 1
-
-        if self.prev_node == 0:
-            self.dynamic[6, :] = 0 # trip overage reset
-        else:
-            self.dynamic[6, chosen_idx] = self.get_overage_time(chosen_idx)/self.graph.time_limit # normalized trip overtime
+        travel = self.get_travel_dist(prev_idx, chosen_idx)
+        trip_over = 0. if prev_idx == 0 else self.get_overage_time(chosen_idx)/self.graph.time_limit
+        self.backend.update_dynamic(self._dyn, chosen_idx, prev_idx, new_load, new_demand,
+                                    trip_over, travel, 1/self.graph.n_vehicles)
 
         if chosen_idx == 0: # return to depot
-            self.dynamic[5, :] = 0 # zero trip time
-            self.dynamic[7, :] += 1/self.graph.n_vehicles # normalized car overage
+            self.trip_time = 0.
         else:
-            self.dynamic[5, chosen_idx] = self.get_travel_dist(prev_idx, chosen_idx)
+            self.trip_time += float(self._dyn[5, chosen_idx]) # running sum of dynamic[5]
 
-    def step(self, action):
+    def step(self, action, copy=False):
         done = False
-        chosen_idx = action.item()
+        chosen_idx = int(action)
 
         if chosen_idx == 0: # reset load and demand to zero per formulation
             new_load = self.graph.num_start
@@ -135,7 +241,7 @@ class Environment:
 
 
         # demand_met = bool(np.abs(self.dynamic[2]).sum() == 0 )
-        all_node_visit = bool((self.dynamic[0][1:] == 1).all())
+        all_node_visit = bool(self._dyn[0, 1:].min() == 1)
         # all_car_used =  bool(self.dynamic[7][0] == self.graph.n_vehicles)
 
         # terminal case
@@ -149,101 +255,40 @@ class Environment:
             self.print_info()
 
         self.state = self.compute_state(chosen_idx)
+        self._reward_buf.fill_(reward)
 
-        info = (self.prev_node, self.t_total, self.tour_indices, self.mask)
+        info = (self.prev_node, self.t_total, self.tour_indices, self._out(self.mask, copy))
 
-        return (self.state, reward, done, info)
+        return (self._out(self.state, copy), self._out(self._reward_buf, copy), done, info)
 
     def compute_mask(self, chosen_idx, last_node):
         """ Compute mask for agent's action """
-        with torch.no_grad():
-            state = self.state
-
-        visited_nodes = state[0].int()
-
-        nbr_nodes = (self.graph.W[chosen_idx] > 0).int()
-        uncovered_nodes = (visited_nodes[:] == 0).int()
-        # uncovered_nodes = (state[2][:] != 0).int()
-
-        cur_load = state[1][last_node]
-        if cur_load ==0:
-            underload = state[2].lt(0)
-        else:
-            underload =torch.zeros_like(state[2], dtype=torch.bool)
-
-        if cur_load ==self.graph.max_load:
-            overload = state[2].gt(0)
-        else:
-            overload =torch.zeros_like(state[2], dtype=torch.bool)
-        #overload = state[2].gt(20 - cur_load)
-        #underload = state[2].lt(0) * state[2].abs().gt(cur_load)
-        #overtime = self.get_next_route_time(chosen_idx) > self.graph.time_limit # TODO need to count time to go back depot
-
-        mask = uncovered_nodes *  ~underload * ~overload # * nbr_nodes * ~overtime
-        mask[last_node] = 0
-        mask[0] = 1  # depot is always available unless last visit
-        mask[chosen_idx] = 0  # mask out visited node
-
-        # mask2 = uncovered_nodes * ~underload *~overload # mask2 without neighbor node restriction
-        # mask2[0] = 1  # depot is always available unless last visit
-        # mask2[last_node] = 0
-        # mask2[chosen_idx] = 0  # mask out visited node
-
-
-        if (visited_nodes == 1).all() or (mask[:] == 0).all():
-            # all nodes are visited or no node to go, then go back to depot
-            mask[:] = 0
-            mask[0] = 1
-
-        #
-        # if (visited_nodes == 1).all() or (mask2[:] == 0).all():
-        #     # all nodes are visited or no node to go, then go back to depot
-        #     mask[:] = 0
-        #     mask[0] = 1
-
-        # elif (mask[1:] == 0).all():
-        #     # when no neighbor node in the graph to go
-        #     mask = mask2
-        #
-        # else:
-        #     pass
-
-        # check if we should return to depot
-        # this condition basically determines the threshold for when the vehicle should go back to the depot
-        if chosen_idx != 0 and not (self.force_n_vehicles and self.trip_count == self.graph.n_vehicles-1):
-            cur_trip_len = self.get_current_route_time()
-            max_trip_len = self.graph.time_limit * (1 + self.overage_percent)
-            visitable = []
-            for i in range(1, self.graph.n_nodes):
-                if mask[i] == 0 or i == chosen_idx:
-                    continue
-                dist_to_depot_i = self.get_travel_dist(chosen_idx, i) + self.get_travel_dist(i, 0)
-                if cur_trip_len + dist_to_depot_i > max_trip_len:
-                    mask[i] = 0
-                else:
-                    visitable.append(i)
-                    
-            if len(visitable) > 0: # mask depot if there are good nodes to visit
-                mask[0] = 0
-
-        # force to visit rest of nodes on last route
-        if self.force_n_vehicles and self.trip_count == self.graph.n_vehicles-1:
-            if mask[1:].sum() == 0: # if no options except depot
-                mask = 1 - self.dynamic[0,:] # unmask all unvisited nodes
-            mask[0] = 0 # mask depot to ensure visitable 
-
-        self.mask = mask.unsqueeze(0)
+        last_trip = self.force_n_vehicles and self.trip_count == self.graph.n_vehicles-1
+        self.backend.compute_mask(self._mask_np[0],
+                                  self._state_cur, # observation before this step
+                                  self._dyn[0],
+                                  self.graph.via_depot[chosen_idx],
+                                  chosen_idx,
+                                  last_node,
+                                  self.graph.max_load,
+                                  chosen_idx != 0 and not last_trip,
+                                  self.get_current_route_time(),
+                                  self.graph.time_limit * (1 + self.overage_percent),
+                                  last_trip)
+
+        self.mask = self._mask_buf
         return self.mask
 
 
     def get_terminal_reward(self, chosen_idx, excess):
         """ Gets the reward when terminal state is reached. """
         reward = 0
-        excess_load = np.abs(self.graph.num_start - excess)
+        excess_load = abs(self.graph.num_start - excess)
 
-        reward_tour = self.get_travel_dist(chosen_idx, 0) # time to go back to depot
-        reward_demand = excess_load * self.graph.penalty_cost_demand # additional bikes on vehicle
-        reward_overage = self.get_overage_last_step(chosen_idx)  * self.graph.penalty_cost_time # overtime
+        # time to go back to depot, additional bikes on vehicle, overtime
+        reward_tour, reward_demand, reward_overage = self.backend.reward_terms(
+            self.get_travel_dist(chosen_idx, 0), excess_load, self.get_overage_last_step(chosen_idx),
+            self.graph.penalty_cost_demand, self.graph.penalty_cost_time)
 
         # if self.dynamic[7][0] > 1:
         #     reward_car = (self.dynamic[7][0] - 1) * self.graph.n_vehicles * 10
@@ -258,13 +303,14 @@ class Environment:
         
         assert(self._get_demand_unvisited()  == 0) # done for now to ensure all nodes are visited at termination.
 
-        return torch.tensor([-reward]) / self.reward_scale
+        return -reward / self.reward_scale
 
     def get_reward(self, chosen_idx):
         """ Gets the reward action.  """
-        reward_tour = self.get_travel_dist(self.prev_node, chosen_idx) # travel time from prev node to next node
-        reward_demand = self.get_demand_reward(chosen_idx) * self.graph.penalty_cost_demand # difference in unmet demand
-        reward_overage = self.get_overage_time(chosen_idx) * self.graph.penalty_cost_time # overtime
+        # travel time from prev node to next node, difference in unmet demand, overtime
+        reward_tour, reward_demand, reward_overage = self.backend.reward_terms(
+            self.get_travel_dist(self.prev_node, chosen_idx), self.get_demand_reward(chosen_idx),
+            self.get_overage_time(chosen_idx), self.graph.penalty_cost_demand, self.graph.penalty_cost_time)
         # reward = reward_tour + reward_demand + reward_overage
 
         # if self.dynamic[7][0] > 1:
@@ -279,41 +325,32 @@ class Environment:
         self.ep_reward_overage -= reward_overage
         # self.ep_reward_car -= reward_car
 
-        return torch.tensor([-reward]) / self.reward_scale
+        return -reward / self.reward_scale
 
     def get_overage_last_step(self, chosen_idx):
         """ Gets the overage time for moving to the depot in the last step.  """
-        dist_to_idx = self.get_current_route_time() + self.get_travel_dist(self.prev_node, chosen_idx)
-        dist_to_depot = self.get_current_route_time() + self.get_travel_dist(self.prev_node, chosen_idx)
-        dist_to_depot += self.get_travel_dist(chosen_idx, 0)
-
-        if dist_to_idx > self.graph.time_limit:
-            return self.get_travel_dist(chosen_idx, 0)
-        elif dist_to_depot > self.graph.time_limit:
-            return dist_to_depot - self.graph.time_limit
-        else:
-            return 0
+        return self.backend.overage_last_step(self.get_current_route_time(),
+                                              self.get_travel_dist(self.prev_node, chosen_idx),
+                                              self.get_travel_dist(chosen_idx, 0),
+                                              self.graph.time_limit)
 
     def get_overage_time(self, chosen_idx):
         """ Gets the overage time for moving a node.  """
-        if self.get_current_route_time() > self.graph.time_limit:
-            return self.get_travel_dist(self.prev_node, chosen_idx)
-        elif self.get_current_route_time() + self.get_travel_dist(self.prev_node, chosen_idx) > self.graph.time_limit:
-            return self.get_current_route_time() + self.get_travel_dist(self.prev_node, chosen_idx) - self.graph.time_limit
-        else:
-            return 0
+        return self.backend.overage_time(self.get_current_route_time(),
+                                         self.get_travel_dist(self.prev_node, chosen_idx),
+                                         self.graph.time_limit)
 
     def get_travel_dist(self, cur_node, next_node):
         """ Gets the travel distance between two nodes.  """
-        return self.graph.W_full[cur_node, next_node]
+        return float(self.graph.W_full[cur_node, next_node])
 
     def get_current_route_time(self):
         """ Gets the current route time. """
-        return self.dynamic[5].sum().item()
+        return self.trip_time
 
     def get_next_route_time(self, chosen_idx):
         """ Gets all the next routes time. """
-        cur_time = self.dynamic[5].sum().item()
+        cur_time = self.trip_time
         # next_time = self.graph.W_weighted[chosen_idx]+ self.graph.W_weighted[chosen_idx][0]
         # next_time[0] = self.graph.W_weighted[chosen_idx][0] # avoid double count depot
         adj = torch.tensor(self.graph.W_weighted.clone().detach())
@@ -329,33 +366,28 @@ class Environment:
         """ Gets the unmet demand at a current node or load if returning to depot. """
         load, demand = self._get_new_load_demand(chosen_idx)
         if chosen_idx == 0:
-            return np.abs(self.graph.num_start - load)
+            return abs(self.graph.num_start - load)
         else:
-            return np.abs(demand)
+            return abs(demand)
 
     def _get_new_load_demand(self, chosen_idx):
         """ Gets the new load and demand from visiting chosen_idx. """
         # difference in unmet demand
-        load_idx = self.dynamic[1].clone()[self.prev_node]
-        demand_idx = self.graph.demands[chosen_idx]
-
-        new_load = torch.clamp(load_idx + demand_idx, max=self.graph.max_load, min=0)
-        load_diff = new_load - load_idx
-        new_demand = demand_idx - load_diff
-
-        return new_load, new_demand
+        load_idx = float(self._dyn[1, self.prev_node])
+        demand_idx = float(self.graph.demands[chosen_idx])
+        return self.backend.new_load_demand(load_idx, demand_idx, float(self.graph.max_load))
 
     def _get_demand_unvisited(self):
-        return np.abs(self.dynamic[2]* (1- self.dynamic[0])).sum()
+        return np.abs(self._dyn[2]* (1- self._dyn[0])).sum()
 
     def print_info(self):
         if self.verbose:
             print("#" * 100)
             print("Tour: ", self.tour_indices)
             print("Tour Reward:    ", self.ep_reward_tour)
-            print("Demand Reward:  ", self.ep_reward_demand.item())
+            print("Demand Reward:  ", self.ep_reward_demand)
             print("Overage Reward: ", self.ep_reward_overage)
-            print("Total Reward:   ", self.ep_reward_overage + self.ep_reward_demand.item() + self.ep_reward_tour)
+            print("Total Reward:   ", self.ep_reward_overage + self.ep_reward_demand + self.ep_reward_tour)
             print("Left Demand: ", np.abs(self.dynamic[2]).sum().item())
             print("Node Visits: ", len(self.tour_indices))
             print("Games Finished: ", self.games)
@@ -428,7 +460,7 @@ class Environment:
 
         plt.xlabel('X')
         plt.ylabel('Y')
-        reward = (self.ep_reward_tour + self.ep_reward_demand + self.ep_reward_overage + self.ep_reward_car).item()
+        reward = float(self.ep_reward_tour + self.ep_reward_demand + self.ep_reward_overage + self.ep_reward_car)
         plt_name = "Game {}, Total Reward: {:.1f} \n " \
                    "Tour: {:.1f}, Demand: {:.1f}, Overage: {:.1f}, Car: {:.1f}\n ".format(self.games, reward,
                                                                  self.ep_reward_tour,
@@ -444,4 +476,212 @@ class Environment:
         plt.savefig(save_path, bbox_inches='tight', dpi=200)
 
         plt.pause(0.001)
-        plt.close()
\ No newline at end of file
+        plt.close()
+
+
+class BatchedEnvironment:
+    """
+    Steps B instances of the BSSrp at once.
+
+    The per-instance episode state (dynamic features, mask, trip time, load, ...)
+    is held in `[B, F, n_nodes]` tensors and every transition is a masked tensor
+    op, so there is no Python work per instance.  Rewards and masks follow
+    `Environment` exactly.  Instances that finish are reset on the same graph.
+    All graphs in a batch must have the same number of nodes.
+    """
+
+    def __init__(self, graph_dict, name, reward_scale=500, force_n_vehicles=True, overage_percent=0.05):
+        self.graph_dict = graph_dict
+        self.name = name
+        self.reward_scale = reward_scale
+        self.force_n_vehicles = force_n_vehicles
+        self.overage_percent = overage_percent
+
+    def reset(self, graph_ids):
+        """ Reset the batch onto `graph_ids`, one graph per instance. """
+        self.games = torch.as_tensor(graph_ids, dtype=torch.long).reshape(-1)
+        graphs = [self.graph_dict[g] for g in self.games.tolist()]
+        self.batch_size = len(graphs)
+        self.n_nodes = graphs[0].n_nodes
+        if any(graph.n_nodes != self.n_nodes for graph in graphs):
+            raise ValueError('all graphs in a batch must have the same number of nodes')
+        self.rows = torch.arange(self.batch_size)
+
+        # static per-instance tensors
+        self.W_full = torch.stack([torch.as_tensor(graph.W_full, dtype=torch.float64) for graph in graphs])
+        self.via_depot = torch.stack([torch.as_tensor(graph.via_depot, dtype=torch.float64) for graph in graphs])
+        self.W_weighted = torch.stack([graph.W_weighted for graph in graphs])
+        self.demands = torch.stack([torch.as_tensor(graph.demands) for graph in graphs]).float()
+        self.pos = torch.stack([(graph.static.T / graph.area).float() for graph in graphs])
+        self.num_start = torch.tensor([graph.num_start for graph in graphs], dtype=torch.float32)
+        self.max_load = torch.tensor([graph.max_load for graph in graphs], dtype=torch.float32)
+        self.n_vehicles = torch.tensor([graph.n_vehicles for graph in graphs])
+        self.time_limit = torch.tensor([graph.time_limit for graph in graphs], dtype=torch.float64)
+        self.penalty_cost_demand = torch.tensor([graph.penalty_cost_demand for graph in graphs], dtype=torch.float64)
+        self.penalty_cost_time = torch.tensor([graph.penalty_cost_time for graph in graphs], dtype=torch.float64)
+
+        # templates the instances are reset from
+        self.dynamic_init = torch.stack([graph.dynamic for graph in graphs]).float()
+        self.state_init = self.compute_state(self.dynamic_init, torch.zeros(self.batch_size, dtype=torch.long))
+        self.dynamic_init[:, 1, 0] = self.num_start
+        self.dynamic_init[:, 7, :] = (1 / self.n_vehicles).unsqueeze(1)
+        self.mask_init = torch.ones(self.batch_size, self.n_nodes, dtype=torch.int)
+        self.mask_init[:, 0] = 0
+
+        self.dynamic = self.dynamic_init.clone()
+        self.state = self.state_init.clone()
+        self.mask = self.mask_init.clone()
+        self.prev_node = torch.zeros(self.batch_size, dtype=torch.long)
+        self.trip_count = torch.zeros(self.batch_size, dtype=torch.long)
+        self.t_total = torch.zeros(self.batch_size, dtype=torch.float64)
+        self.trip_time = torch.zeros(self.batch_size, dtype=torch.float64)
+        self.ep_reward_tour = torch.zeros(self.batch_size, dtype=torch.float64)
+        self.ep_reward_demand = torch.zeros(self.batch_size, dtype=torch.float64)
+        self.ep_reward_overage = torch.zeros(self.batch_size, dtype=torch.float64)
+        self.final_state = self.state.clone()
+
+        return self.state, self.W_weighted, self.mask
+
+    def reset_done(self, done):
+        """ Reset the instances flagged in `done` onto their current graph. """
+        self.dynamic[done] = self.dynamic_init[done]
+        self.state[done] = self.state_init[done]
+        self.mask[done] = self.mask_init[done]
+        self.prev_node[done] = 0
+        self.trip_count[done] = 0
+        self.t_total[done] = 0.
+        self.trip_time[done] = 0.
+        self.ep_reward_tour[done] = 0.
+        self.ep_reward_demand[done] = 0.
+        self.ep_reward_overage[done] = 0.
+
+    def compute_state(self, dynamic, chosen_idx):
+        """ Batched `Environment.compute_state`, returns `[B, 7, n_nodes]`. """
+        rows = torch.arange(dynamic.shape[0])
+        per_node = dynamic[:, [VISITED, DEMAND]]
+        at_chosen = dynamic[rows, :, chosen_idx][:, [LOAD, TRIP_TIME, TRIP_OVER]]
+        at_chosen = at_chosen.unsqueeze(2).expand(-1, -1, self.n_nodes)
+        return torch.cat((per_node, at_chosen, self.pos), dim=1)
+
+    def step(self, actions):
+        """
+        Step every instance with `actions[B]`.
+
+        Returns `(state, reward, done, mask)` batched over instances.  For the
+        instances flagged in `done`, `state`/`mask` already belong to the next
+        episode; their terminal state is kept in `self.final_state`.
+        """
+        rows = self.rows
+        chosen = torch.as_tensor(actions, dtype=torch.long).reshape(-1)
+        prev = self.prev_node
+        at_depot = chosen == 0
+        time_limit = self.time_limit
+
+        # load and demand after visiting the chosen node
+        load_prev = self.dynamic[rows, LOAD, prev]
+        demand_chosen = self.demands[rows, chosen]
+        new_load = torch.minimum(torch.clamp(load_prev + demand_chosen, min=0), self.max_load)
+        new_demand = demand_chosen - (new_load - load_prev)
+        demand_term = torch.where(at_depot, torch.abs(self.num_start - new_load), torch.abs(new_demand))
+        new_load = torch.where(at_depot, self.num_start, new_load)
+        new_demand = torch.where(at_depot, torch.zeros_like(new_demand), new_demand)
+        self.trip_count += at_depot
+
+        # step reward, same terms as `Environment.get_reward`
+        travel = self.W_full[rows, prev, chosen]
+        route_time = self.trip_time
+        overage = torch.where(route_time > time_limit, travel,
+                              torch.clamp(route_time + travel - time_limit, min=0))
+        reward_tour = travel
+        reward_demand = demand_term.double() * self.penalty_cost_demand
+        reward_overage = overage * self.penalty_cost_time
+        reward = -(reward_tour + reward_demand + reward_overage) / self.reward_scale
+        self.ep_reward_tour -= reward_tour
+        self.ep_reward_demand -= reward_demand
+        self.ep_reward_overage -= reward_overage
+
+        # update dynamic features
+        dynamic = self.dynamic
+        dynamic[rows, VISITED, chosen] = torch.where(at_depot, dynamic[rows, VISITED, chosen], torch.ones_like(new_load))
+        dynamic[rows, LOAD, chosen] = new_load
+        dynamic[rows, DEMAND, chosen] = new_demand
+        dynamic[:, CURR_NODE] = 0
+        dynamic[rows, CURR_NODE, chosen] = 1
+        dynamic[:, PREV_NODE] = 0
+        dynamic[rows, PREV_NODE, prev] = 1
+        left_depot = prev != 0
+        dynamic[:, TRIP_OVER] *= left_depot.unsqueeze(1)
+        dynamic[rows, TRIP_OVER, chosen] = torch.where(left_depot, overage / time_limit, torch.zeros_like(overage)).float()
+        dynamic[:, TRIP_TIME] *= ~at_depot.unsqueeze(1)
+        dynamic[rows, TRIP_TIME, chosen] = torch.where(at_depot, torch.zeros_like(travel), travel).float()
+        dynamic[:, 7] += at_depot.unsqueeze(1) / self.n_vehicles.unsqueeze(1)
+        self.trip_time = torch.where(at_depot, torch.zeros_like(travel), self.trip_time + travel.float())
+
+        self.mask = self.compute_mask(chosen, prev)
+        self.t_total += travel
+        self.prev_node = chosen.clone()
+
+        # terminal case, same terms as `Environment.get_terminal_reward`
+        done = (dynamic[:, VISITED, 1:] == 1).all(dim=1)
+        to_depot = self.W_full[rows, chosen, 0]
+        route_time = self.trip_time
+        overage_last = torch.where(route_time > time_limit, to_depot,
+                                   torch.clamp(route_time + to_depot - time_limit, min=0))
+        reward_tour = to_depot * done
+        reward_demand = torch.abs(self.num_start - new_load).double() * self.penalty_cost_demand * done
+        reward_overage = overage_last * self.penalty_cost_time * done
+        terminal = -(reward_tour + reward_demand + reward_overage) / self.reward_scale
+        reward = torch.where(done, reward + terminal, reward).float()
+        self.ep_reward_tour -= reward_tour
+        self.ep_reward_demand -= reward_demand
+        self.ep_reward_overage -= reward_overage
+        self.t_total += reward_tour
+
+        self.state = self.compute_state(dynamic, chosen)
+
+        if done.any():
+            self.final_state = self.state.clone()
+            self.reset_done(done)
+
+        return self.state, reward, done, self.mask
+
+    def compute_mask(self, chosen_idx, last_node):
+        """ Batched `Environment.compute_mask`, returns `[B, n_nodes]`. """
+        rows = self.rows
+        state = self.state  # observation before this step, as in `Environment`
+
+        visited_nodes = state[:, 0].int()
+        uncovered_nodes = visited_nodes == 0
+
+        cur_load = state[rows, 1, last_node].unsqueeze(1)
+        underload = (cur_load == 0) & state[:, 2].lt(0)
+        overload = (cur_load == self.max_load.unsqueeze(1)) & state[:, 2].gt(0)
+
+        mask = (uncovered_nodes & ~underload & ~overload).int()
+        mask[rows, last_node] = 0
+        mask[:, 0] = 1  # depot is always available unless last visit
+        mask[rows, chosen_idx] = 0  # mask out visited node
+
+        # all nodes are visited or no node to go, then go back to depot
+        back_to_depot = (visited_nodes == 1).all(dim=1) | (mask == 0).all(dim=1)
+        mask[back_to_depot] = 0
+        mask[back_to_depot, 0] = 1
+
+        # drop nodes whose return to the depot would exceed the trip limit
+        last_trip = self.force_n_vehicles & (self.trip_count == self.n_vehicles - 1)
+        check_time = (chosen_idx != 0) & ~last_trip
+        cur_trip_len = self.trip_time.unsqueeze(1)
+        max_trip_len = (self.time_limit * (1 + self.overage_percent)).unsqueeze(1)
+        candidates = (mask[:, 1:] != 0) & check_time.unsqueeze(1)
+        candidates[rows, chosen_idx - 1] &= chosen_idx == 0
+        too_far = cur_trip_len + self.via_depot[rows, chosen_idx, 1:] > max_trip_len
+        mask[:, 1:] *= ~(candidates & too_far)
+        visitable = (candidates & ~too_far).any(dim=1)
+        mask[visitable, 0] = 0  # mask depot if there are good nodes to visit
+
+        # force to visit rest of nodes on last route
+        no_option = last_trip & (mask[:, 1:].sum(dim=1) == 0)
+        mask[no_option] = (1 - self.dynamic[no_option, VISITED]).int()
+        mask[last_trip, 0] = 0
+
+        return mask
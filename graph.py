@@ -1,8 +1,14 @@
 import numpy as np
 import networkx as nx
 import collections
+import json
+import logging
+import multiprocessing as mp
+from functools import partial, cached_property
 from sklearn.decomposition import PCA
 from scipy.spatial.distance import pdist, squareform
+from scipy.spatial import cKDTree
+import pandas as pd
 import matplotlib.pyplot as plt
 import os
 import torch
@@ -28,7 +34,11 @@ class Graph:
                  bike_load_time=0.0,
                  max_load=20,
                  max_demand=9,
-                 area=10):
+                 area=10,
+                 seed=None,
+                 locations=None,
+                 demands=None,
+                 edges=None):
 
         if max_load < max_demand:
             raise ValueError(':param max_load: must be > max_demand')
@@ -47,9 +57,14 @@ class Graph:
         self.starting_fraction = starting_fraction
         self.num_start = int(self.max_load * self.starting_fraction)
 
-        self.rng = np.random.RandomState()
-        self.seed_used = None
-        self.bss_graph_gen()
+        # every random draw of the instance comes from its own generator,
+        # e.g. seed=(base_seed, index) as in generate_graphs
+        self.rng = np.random.RandomState(seed)
+        self.seed_used = seed
+        if locations is None:
+            self.bss_graph_gen()
+        else:
+            self.station_graph_gen(locations, demands, edges)
 
     def seed(self, _seed):
         self.seed_used = _seed
@@ -57,23 +72,45 @@ class Graph:
 
     def gen_instance(self):  # Generate random instance
         # self.rng.seed(0)
-        self.locations = self.rng.rand(self.n_nodes, 2) * self.area  # node num with (dimension) coordinates in [0,1]
-        pca = PCA(n_components=2)  # center & rotate coordinates
-        self.locations[0] = [0.5 * self.area , 0.5 * self.area]  # force depot to be at center
-        self.locations = pca.fit_transform(self.locations)
+        self.locations = self.gen_locations()
         self.refresh_demand()
 
+    def gen_locations(self, max_depot_time=30, max_tries=100):
+        """
+        Draws locations until every station is less than `max_depot_time`
+        minutes from the depot, giving up after `max_tries` draws.
+        """
+        for tries in range(1, max_tries + 1):
+            locations = self.rng.rand(self.n_nodes, 2) * self.area  # node num with (dimension) coordinates in [0,1]
+            pca = PCA(n_components=2)  # center & rotate coordinates
+            locations[0] = [0.5 * self.area , 0.5 * self.area]  # force depot to be at center
+            locations = pca.fit_transform(locations)
+
+            depot_time = self.get_time_based_distance_matrix(np.linalg.norm(locations - locations[0], axis=1))
+            if np.all(depot_time < max_depot_time):
+                self.location_tries = tries
+                return locations
+
+        raise ValueError('no station layout within {} minutes of the depot after {} draws'.format(max_depot_time, max_tries))
+
+    @property
+    def location_acceptance_rate(self):
+        return 1. / self.location_tries
+
     def get_norm_demand(self):
         x = np.arange(-self.max_demand, self.max_demand+1)
         xU, xL = x + 0.5, x - 0.5
         prob = stats.norm.cdf(xU, scale=3) - stats.norm.cdf(xL, scale=3)
         prob = prob / prob.sum()
-        demand = np.random.choice(x, size=self.n_nodes, p=prob)
+        demand = self.rng.choice(x, size=self.n_nodes, p=prob)
         return  demand
 
     def refresh_demand(self):
-        self.demands = self.get_demands()
-        # self.demands = self.get_norm_demand()
+        self.set_demands(self.get_demands())
+        # self.set_demands(self.get_norm_demand())
+
+    def set_demands(self, demands):
+        self.demands = demands
         demands_tensor = torch.tensor(self.demands)
         cur_node = torch.zeros(self.n_nodes)
         prev_node = torch.zeros(self.n_nodes)
@@ -98,6 +135,8 @@ class Graph:
         W_val = squareform(pdist(coords, metric='euclidean'))
         W_val = self.get_time_based_distance_matrix(W_val)
         self.W_full = W_val.copy()
+        # via_depot[i, j] = W_full[i, j] + W_full[j, 0], time to go i -> j and then back to the depot
+        self.via_depot = self.W_full + self.W_full[:, 0][np.newaxis, :]
 
         W = np.zeros((n_nodes, n_nodes))
         knns = np.argpartition(W_val, kth=num_neighbors, axis=-1)[:, num_neighbors::-1]
@@ -106,20 +145,39 @@ class Graph:
         W[0, :] = 1
         W[:, 0] = 1
 
-        for idx in range(n_nodes):
-            W[idx][knns[idx]] = 1
-            W = W.T
-            W[idx][knns[idx]] = 1
+        # node i is linked to its k nearest neighbors and to every node having i among its own
+        W[np.arange(n_nodes)[:, np.newaxis], knns] = 1
+        W = np.maximum(W, W.T)
 
         # np.fill_diagonal(W, 0)
 
         W_val *= W
         return W.astype(int), W_val
 
+    def knn_edges(self, coords, num_neighbors):
+        """
+        Edge list of the same graph as `adjacenct_gen`, built with a KD-tree in
+        O(n k log n) instead of the n x n distance matrix.
+        """
+        n_nodes = coords.shape[0]
+        _, knns = cKDTree(coords).query(coords, k=num_neighbors + 1)
+        source = np.repeat(np.arange(n_nodes), num_neighbors + 1)
+        target = knns.reshape(-1)
+        stations = np.arange(1, n_nodes)
+        depot = np.zeros_like(stations)
+
+        # both directions of every KNN link, and the depot linked to every station
+        source, target = np.concatenate((source, target, depot, stations)), np.concatenate((target, source, stations, depot))
+        keep = source != target
+        pairs = np.unique(source[keep] * n_nodes + target[keep])
+        edge_index = np.stack((pairs // n_nodes, pairs % n_nodes))
+        edge_weight = self.get_time_based_distance_matrix(np.linalg.norm(coords[edge_index[0]] - coords[edge_index[1]], axis=1))
+        return torch.tensor(edge_index), torch.tensor(edge_weight)
+
     def node_emb(self,adj):
         pmi_inf = compute_pmi_inf(adj)
         pmi_inf_trans = compute_log_ramp(pmi_inf, T = 3)
-        adj = compute_mat_embed(pmi_inf_trans, dims = 4)
+        adj = compute_mat_embed(pmi_inf_trans, dims = 4, v0 = self.emb_v0)
         return adj
 
     def get_time_based_distance_matrix(self, W):
@@ -128,16 +186,119 @@ class Graph:
     def bss_graph_gen(self):
         self.gen_instance()
         self.W, self.W_val = self.adjacenct_gen(self.n_nodes, self.num_neighbors, self.static)
-        while np.any(self.W_val[0]>=30):
-            self.W, self.W_val = self.adjacenct_gen(self.n_nodes, self.num_neighbors, self.static)
-        self.W_weighted = np.multiply(self.W_val, self.W)
-        self.emb = torch.tensor(self.node_emb(self.W_weighted))
-        self.W_weighted = torch.tensor(self.W_weighted)
+        self.W_weighted = torch.tensor(np.multiply(self.W_val, self.W))
         self.W = torch.tensor(self.W)
-        self.A = sparse.csr_matrix(self.W_weighted)
-        self.g = nx.from_numpy_matrix(np.matrix(self.W), create_using=nx.Graph)
-        self.g_weighted = nx.from_numpy_matrix(np.matrix(self.W_weighted), create_using=nx.Graph)
-        self.g.edges(data=True)
+        # drawn now so the instance does not depend on when the embedding is computed
+        self.emb_v0 = self.rng.rand(self.n_nodes)
+
+    def station_graph_gen(self, locations, demands, edges=None):
+        """
+        Builds the instance from given locations, demands and optionally the
+        (edge_index, edge_weight) KNN graph; dense matrices are only built if used.
+        """
+        self.locations = np.asarray(locations, dtype=float)
+        self.set_demands(np.asarray(demands))
+        if edges is None:
+            edges = self.knn_edges(self.locations, self.num_neighbors)
+        self.edge_index, self.edge_weight = (torch.as_tensor(e) for e in edges)
+        self.emb_v0 = self.rng.rand(self.n_nodes)
+
+    @classmethod
+    def from_stations(cls, path, k_nn, n_vehicles, penalty_cost_demand, penalty_cost_time, speed, time_limit,
+                      x_col='x', y_col='y', demand_col='demand', depot=0, area=None, chunksize=100000,
+                      cache=True, **graph_kwargs):
+        """
+        Builds an instance from a CSV or Parquet table of stations, one row per
+        station with its coordinates in km and its demand. Row `depot` is the
+        depot and coordinates are centered on their mean.
+
+        The table is read in chunks of `chunksize` rows. With `cache`, the
+        instance data are saved to a `<path>.npz` sidecar which is reused as
+        long as the table and the arguments are unchanged.
+        """
+        key = json.dumps([os.path.getsize(path), os.stat(path).st_mtime_ns, x_col, y_col, demand_col, depot, k_nn, speed])
+        sidecar = path + '.npz'
+        if cache and os.path.isfile(sidecar):
+            data = np.load(sidecar)
+            if str(data['key']) == key:
+                graph = cls(len(data['demands']), k_nn, n_vehicles, penalty_cost_demand, penalty_cost_time, speed,
+                            time_limit, area=float(data['area']) if area is None else area,
+                            locations=data['locations'], demands=data['demands'],
+                            edges=(data['edge_index'], data['edge_weight']), **graph_kwargs)
+                return graph
+
+        table = read_stations(path, [x_col, y_col, demand_col], chunksize)
+        order = np.r_[depot, np.delete(np.arange(len(table[x_col])), depot)]  # depot first
+        locations = np.stack((table[x_col], table[y_col]), axis=1)[order].astype(float)
+        locations -= locations.mean(axis=0)
+        demands = table[demand_col][order].astype(int)
+        demands[0] = 0
+        if area is None:
+            area = float(np.ptp(locations, axis=0).max())
+
+        graph = cls(len(demands), k_nn, n_vehicles, penalty_cost_demand, penalty_cost_time, speed, time_limit,
+                    area=area, locations=locations, demands=demands, **graph_kwargs)
+        if cache:
+            with open(sidecar, 'wb') as f:
+                np.savez(f, key=key, area=area, locations=locations, demands=demands,
+                         edge_index=graph.edge_index.numpy(), edge_weight=graph.edge_weight.numpy())
+        return graph
+
+    # dense views of instances built from an edge list, see station_graph_gen
+
+    @cached_property
+    def W_full(self):
+        return self.get_time_based_distance_matrix(squareform(pdist(self.locations, metric='euclidean')))
+
+    @cached_property
+    def via_depot(self):
+        return self.W_full + self.W_full[:, 0][np.newaxis, :]
+
+    @cached_property
+    def W_weighted(self):
+        W_weighted = torch.zeros(self.n_nodes, self.n_nodes, dtype=self.edge_weight.dtype)
+        W_weighted[self.edge_index[0], self.edge_index[1]] = self.edge_weight
+        return W_weighted
+
+    @cached_property
+    def W(self):
+        return (self.W_weighted != 0).long() + torch.eye(self.n_nodes, dtype=torch.long)
+
+    # the environment does not use the following, they are built on first access
+
+    @cached_property
+    def emb(self):
+        return torch.tensor(self.node_emb(self.W_weighted.numpy()))
+
+    @cached_property
+    def A(self):
+        return sparse.csr_matrix(self.W_weighted)
+
+    @cached_property
+    def g(self):
+        return nx.from_numpy_matrix(np.matrix(self.W), create_using=nx.Graph)
+
+    @cached_property
+    def g_weighted(self):
+        return nx.from_numpy_matrix(np.matrix(self.W_weighted), create_using=nx.Graph)
+
+    @cached_property
+    def edge_index(self):
+        """
+        `[2, n_edges]` (source, target) pairs of the KNN graph, the nonzero entries of `W_weighted` in row-major order.
+        Generated graphs derive it from their dense matrices; only `from_stations` builds it without them.
+        """
+        return self.W_weighted.nonzero().T.contiguous()
+
+    @cached_property
+    def edge_weight(self):
+        """ `[n_edges]` travel times of the edges in `edge_index`. """
+        return self.W_weighted[self.edge_index[0], self.edge_index[1]]
+
+    @staticmethod
+    def max_edges(n_nodes, k_nn):
+        """ Upper bound on the number of edges: depot row and column plus both directions of every KNN link. """
+        return 2 * (n_nodes - 1) + 2 * n_nodes * k_nn
 
     def nodes(self):
 
@@ -202,6 +363,111 @@ class Graph:
         return demands
 
 
+def read_stations(path, columns, chunksize=100000):
+    """ Streams `columns` of a CSV or Parquet table into NumPy arrays, `chunksize` rows at a time. """
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('reading Parquet station tables requires pyarrow to be installed')
+        chunks = (batch.to_pandas() for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns))
+    else:
+        chunks = pd.read_csv(path, usecols=columns, chunksize=chunksize)
+
+    parts = {c: [] for c in columns}
+    for chunk in chunks:
+        for c in columns:
+            parts[c].append(chunk[c].to_numpy())
+    return {c: np.concatenate(parts[c]) for c in columns}
+
+
+def sample_demands(rng, batch_size, n_nodes, max_demand):
+    """
+    Draws `[batch_size, n_nodes]` zero-sum demand vectors with the support of
+    `Graph.get_demands`: 0 at the depot, nonzero and within
+    `[-max_demand, max_demand]` at the stations.
+
+    Starts from the same initial draw and applies the same +-1 corrections
+    (jumping over 0, skipping stations at the bound), but corrects
+    `|sum| // 2` distinct stations of every row per round instead of one.
+    """
+    demands = rng.randint(1, max_demand, (batch_size, n_nodes))
+    demands *= rng.choice([-1, 1], (batch_size, n_nodes))
+    demands[:, 0] = 0
+
+    active = np.arange(batch_size)
+    while True:
+        total = demands[active].sum(axis=1)
+        active, total = active[total != 0], total[total != 0]  # rows left to correct
+        if len(active) == 0:
+            return demands
+        rows = demands[active]
+
+        # every correction moves the sum by 1 or 2 towards 0, so this never overshoots by more than 1
+        n_picked = np.maximum(1, np.abs(total) // 2)
+        keys = rng.rand(len(active), n_nodes - 1)
+        threshold = np.sort(keys, axis=1)[np.arange(len(active)), np.minimum(n_picked, n_nodes - 1) - 1]
+        picked = np.zeros_like(rows, dtype=bool)
+        picked[:, 1:] = keys <= threshold[:, np.newaxis]  # n_picked random distinct stations
+
+        down = picked & (total > 0)[:, np.newaxis] & (rows != -max_demand)
+        up = picked & (total < 0)[:, np.newaxis] & (rows != max_demand)
+        step = up.astype(rows.dtype) - down
+        step[down & (rows == 1)] = -2  # 1 to -1
+        step[up & (rows == -1)] = 2  # -1 to 1
+        demands[active] = rows + step
+
+
+def demand_stats(demands, max_demand):
+    """ Marginal statistics of station demands (the depot column is left out). """
+    stations = np.asarray(demands)[:, 1:]
+    values = np.arange(-max_demand, max_demand + 1)
+    counts = (stations.reshape(-1, 1) == values).sum(axis=0)
+    return {
+        'values': values,
+        'pmf': counts / counts.sum(),
+        'mean': stations.mean(),
+        'std': stations.std(),
+        'abs_mean': np.abs(stations).mean(),
+        'at_bound': np.mean(np.abs(stations) == max_demand),
+        'zero_sum': bool((np.asarray(demands).sum(axis=1) == 0).all()),
+    }
+
+
+def _seeded_graph(base_seed, graph_kwargs, node_sizes, index):
+    if node_sizes:
+        graph_kwargs = dict(graph_kwargs, n_nodes=node_sizes[index % len(node_sizes)])
+    return Graph(seed=(base_seed, index), **graph_kwargs)
+
+
+def generate_graphs(n_graphs, base_seed=0, workers=1, chunksize=None, node_sizes=None, **graph_kwargs):
+    """
+    Builds `{index: Graph}` for `index` in `range(n_graphs)` on a pool of
+    `workers` processes. Graph `index` is seeded with `(base_seed, index)`,
+    so the instances do not depend on the number of workers. With
+    `node_sizes`, graph `index` has `node_sizes[index % len(node_sizes)]`
+    nodes instead of `n_nodes`.
+    """
+    make = partial(_seeded_graph, base_seed, graph_kwargs, node_sizes)
+    log_every = max(1, n_graphs // 10)
+    if chunksize is None:
+        chunksize = max(1, n_graphs // (4 * workers))
+
+    graph_dict = {}
+    pool = mp.Pool(workers) if workers > 1 else None
+    try:
+        graphs = pool.imap(make, range(n_graphs), chunksize) if pool else map(make, range(n_graphs))
+        for index, g in enumerate(graphs):
+            graph_dict[index] = g
+            if (index + 1) % log_every == 0 or index + 1 == n_graphs:
+                logging.info('Generated {}/{} graphs'.format(index + 1, n_graphs))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return graph_dict
+
+
 # Toy Case Test
 def test():
     g = Graph(
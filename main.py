@@ -2,11 +2,12 @@ import argparse
 import agent
 import environment
 import runner
+import vec_env
 import graph
+import instances
 import logging
 import numpy as np
 import sys
-import pickle
 import os
 import time
 from utils.vis import str2bool
@@ -21,7 +22,7 @@ parser = argparse.ArgumentParser(description='RL running machine')
 parser.add_argument('--environment_name', metavar='ENV_CLASS', type=str, default='bss', help='Class to use for the environment. Must be in the \'environment\' module')
 parser.add_argument('--agent', metavar='AGENT_CLASS', default='Agent', type=str, help='Class to use for the agent. Must be in the \'agent\' module.')
 parser.add_argument('--graph_nbr', type=int, default='5000', help='number of differente graph to generate for the training sample')
-parser.add_argument('--model', type=str, default='GATv2', help='model name')
+parser.add_argument('--model', type=str, default='GATv2', help='model name, GATv2 or GATv2_encdec (graph encoded once per episode)')
 parser.add_argument('--ngames', type=int, metavar='n', default='4000', help='number of games to simulate') #1250
 parser.add_argument('--nepisode', type=int, metavar='n', default=5, help='max number of episodes per game')
 parser.add_argument('--niter', type=int, metavar='n', default='100', help='max number of iterations per episode')
@@ -45,46 +46,76 @@ parser.add_argument('--max_load', type=int, default=20, help='maximum vehicle ca
 parser.add_argument('--max_demand', type=int, default=9, help='maximum demand at each station' )
 parser.add_argument('--force_n_vehicles', type=bool, default=True, help='force agent to respect vehicle limit by masking.')
 parser.add_argument('--n_features',type=int, default=7, help="number of features in GNN")
+parser.add_argument('--seed', type=int, default=120, help='base seed, graph i is generated from (seed, i)')
+parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes generating graphs')
+parser.add_argument('--vec_envs', type=int, default=0, help='if > 0, train with Runner.train_async on this many environment worker processes, for the same number of episodes as --epoch x --ngames x --nepisode')
+parser.add_argument('--sparse', type=str2bool, default=False, help='pass graphs as edge lists instead of dense matrices')
+parser.add_argument('--edge_encoder', type=str, default='mlp', choices=['mlp', 'dense'], help='per-edge MLP, or the n_nodes**2 x n_nodes**2 layer of older models')
+parser.add_argument('--compile', type=str2bool, default=False, help='validate with a TorchScript trace of the policy network, cached in trained_models/compiled')
+parser.add_argument('--quantize', type=str2bool, default=False, help='validate with an int8 copy of the policy network, instead of --compile; refused with a warning if its greedy actions differ from the float network, see DQAgent.load_model')
+parser.add_argument('--node_sizes', type=str, default=None, help='comma separated station counts, e.g. 10,20,50: train one model on graphs of all these sizes instead of --n_nodes')
+parser.add_argument('--lazy_cache', type=int, default=0, help='if > 0, build training graphs on demand and keep this many in an LRU cache')
 
 
 def main():
     args = parser.parse_args()
     logging.info('Loading graph: nodes{}, ngames {}, graph_nbr {}, knn {} '.format(args.n_nodes, args.ngames, args.graph_nbr, args.knn))
     val_mode = str2bool(args.val)
+    node_sizes = [int(n) for n in args.node_sizes.split(',')] if args.node_sizes else None
+    if node_sizes and args.lazy_cache > 0:
+        parser.error('--node_sizes does not support --lazy_cache')
+    if args.vec_envs > 0 and (node_sizes or args.sparse):
+        parser.error('--vec_envs needs dense graphs of a single size')
+    max_edges = graph.Graph.max_edges(max(node_sizes or [args.n_nodes]), args.knn) if args.sparse else None
+    graph_kwargs = dict(n_nodes=args.n_nodes,
+                        k_nn=args.knn,
+                        n_vehicles=args.n_car,
+                        penalty_cost_demand=args.coeff_demand,
+                        penalty_cost_time=args.coeff_time,
+                        speed=args.car_speed,
+                        time_limit=args.time_limit,
+                        starting_fraction=args.starting_fraction,
+                        max_demand=args.max_demand,
+                        max_load=args.max_load)
 
     if not val_mode:
 
         start_time = time.time()
-        graph_dic_train = {}
-        for graph_ in range(args.graph_nbr):
-            seed = np.random.seed(120 + graph_)
-
-            graph_dic_train[graph_] = graph.Graph(n_nodes=args.n_nodes,
-                                            k_nn=args.knn,
-                                            n_vehicles=args.n_car,
-                                            penalty_cost_demand=args.coeff_demand,
-                                            penalty_cost_time=args.coeff_time,
-                                            speed=args.car_speed,
-                                            time_limit=args.time_limit,
-                                            starting_fraction=args.starting_fraction,
-                                            max_demand=args.max_demand,
-                                            max_load=args.max_load)
+        if args.lazy_cache > 0:
+            graph_dic_train = instances.LazyGraphStore(args.graph_nbr, base_seed=args.seed, cache_size=args.lazy_cache, **graph_kwargs)
+        else:
+            graph_dic_train = graph.generate_graphs(args.graph_nbr, base_seed=args.seed, workers=args.workers, node_sizes=node_sizes, **graph_kwargs)
 
         logging.info('Loading agent...')
-        agent_class = agent.Agent(args.model, args.lr, args.bs, args.replace_freq, args.n_nodes, args.n_features)
+        agent_class = agent.Agent(args.model, args.lr, args.bs, args.replace_freq, args.n_nodes, args.n_features, max_edges=max_edges, edge_encoder=args.edge_encoder, node_buckets=node_sizes)
 
         logging.info('Loading environment %s' % args.environment_name)
         env_train = environment.Environment(graph_dic_train,
             args.environment_name, 
             penalty_unvisited=args.penalty_unvisited, 
             reward_scale=args.reward_scale,
-            force_n_vehicles=str2bool(args.force_n_vehicles))
+            force_n_vehicles=str2bool(args.force_n_vehicles),
+            sparse=args.sparse)
 
         print("Training...")
         runner_train = runner.Runner(env_train, agent_class, args.verbose, render = False)
-        cumul_reward_list, cumul_loss_list, cumul_epsilon_list = runner_train.train_loop(args.ngames, args.epoch, args.nepisode, args.niter)
+        if args.vec_envs > 0:
+            # the workers step while the agent acts and learns, see Runner.train_async
+            vec_env_train = vec_env.SubprocVectorEnv(graph_dic_train, args.environment_name, args.vec_envs,
+                n_episodes=args.nepisode,
+                penalty_unvisited=args.penalty_unvisited,
+                reward_scale=args.reward_scale,
+                force_n_vehicles=str2bool(args.force_n_vehicles))
+            try:
+                cumul_reward_list, cumul_loss_list, cumul_epsilon_list = runner_train.train_async(vec_env_train, args.epoch * args.ngames * args.nepisode)
+            finally:
+                vec_env_train.close()
+        else:
+            cumul_reward_list, cumul_loss_list, cumul_epsilon_list = runner_train.train_loop(args.ngames, args.epoch, args.nepisode, args.niter)
         print("Training finished after {} episodes".format(len(cumul_reward_list)))
         agent_class.save_model()
+        if args.lazy_cache > 0:
+            graph_dic_train.log_cache_info()
 
         print("Time to train:", time.time() - start_time)
 
@@ -95,45 +126,35 @@ def main():
 
         start_time = time.time()
 
-        dataset = 'graph_dic_val.pickle'
-        load_data = os.path.isfile(dataset)
+        dataset = 'graph_dic_val'
 
-        if load_data:
+        if os.path.isdir(dataset):
             # Load Validation Dataset
-            with open('graph_dic_val.pickle', 'rb') as handle:
-                graph_dic_val = pickle.load(handle)
-            ngames = len(graph_dic_val)
+            graph_dic_val = instances.InstanceDataset(dataset)
+        elif os.path.isfile('graph_dic_val.pickle'):
+            # Convert the pickled Validation Dataset once
+            graph_dic_val = instances.InstanceDataset.from_pickle('graph_dic_val.pickle', dataset)
         else:
-            # Create New Validation Dataset
-            graph_dic_val = {}
-            ngames = 1000
-
-            for graph_ in range(ngames):
-                graph_dic_val[graph_] = graph.Graph(n_nodes=args.n_nodes,
-                                                k_nn=args.knn,
-                                                n_vehicles=args.n_car,
-                                                penalty_cost_demand=args.coeff_demand,
-                                                penalty_cost_time=args.coeff_time,
-                                                speed=args.car_speed,
-                                                time_limit=args.time_limit,
-                                                starting_fraction=args.starting_fraction,
-                                                max_demand=args.max_demand,
-                                                max_load=args.max_load)
+            # Create New Validation Dataset, seeded apart from the training graphs
+            graphs = graph.generate_graphs(1000, base_seed=args.seed + 1, workers=args.workers, **graph_kwargs)
 
             # Save Validation Dataset
-            with open('graph_dic_val.pickle', 'wb') as handle:
-                pickle.dump(graph_dic_val, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            graph_dic_val = instances.InstanceDataset.write(dataset, graphs)
+        ngames = len(graph_dic_val)
 
         logging.info('Loading agent...')
-        agent_class = agent.Agent(args.model, args.lr, args.bs, args.replace_freq, args.n_nodes, args.n_features)
-        agent_class.load_model("model.pt")
+        agent_class = agent.Agent(args.model, args.lr, args.bs, args.replace_freq, args.n_nodes, args.n_features, max_edges=max_edges, edge_encoder=args.edge_encoder)
+        agent_class.load_model("model.pt", quantize=args.quantize)
+        if args.compile and agent_class.inference_net is None:
+            agent_class.compile_inference()
 
         logging.info('Loading environment %s' % args.environment_name)
         env_val = environment.Environment(graph_dic_val, 
             args.environment_name, 
             penalty_unvisited=args.penalty_unvisited, 
             reward_scale=args.reward_scale,
-            force_n_vehicles=str2bool(args.force_n_vehicles))
+            force_n_vehicles=str2bool(args.force_n_vehicles),
+            sparse=args.sparse)
 
         print("Validating...")
         runner_val = runner.Runner(env_val, agent_class, args.verbose, render=False)
@@ -16,8 +16,9 @@ def compute_log_ramp(pmi_inf, T=3, thresh=np.finfo(float).eps):
     pmi_inf_trans = T * np.log(np.maximum(thresh, 1. + pmi_inf / T))
     return pmi_inf_trans
 
-def compute_mat_embed(mat, dims=128):
-    w, v = sp.sparse.linalg.eigsh(mat, k=dims)
+def compute_mat_embed(mat, dims=128, v0=None):
+    # ARPACK starts from a random vector unless v0 is given
+    w, v = sp.sparse.linalg.eigsh(mat, k=dims, v0=v0)
     return np.sqrt(np.abs(w))[np.newaxis,:] * v
 
 def test():
@@ -1,8 +1,11 @@
 import torch
 import torch.nn as nn
 from labml_helpers.module import Module
+import collections
+import logging
 import os
 import torch.nn.functional as f
+from typing import NamedTuple
 
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
 
@@ -16,6 +19,204 @@ def normalize(A):
     return D.bmm(A).bmm(D)
 
 
+def add_batch_dim(adj):
+    """ Adds a batch dimension to a dense adjacency matrix or to an (edge_index, edge_weight) pair. """
+    if isinstance(adj, tuple):
+        return tuple(t.unsqueeze(0) for t in adj)
+    return adj.unsqueeze(0)
+
+
+def scatter_softmax(src, index, n_segments):
+    """ Softmax of `src` `[n_items, ...]` within the segments given by `index` `[n_items]`. """
+    shape = (n_segments,) + src.shape[1:]
+    index_ = index.view(-1, *([1] * (src.dim() - 1))).expand_as(src)
+    seg_max = torch.full(shape, float('-inf'), dtype=src.dtype, device=src.device)
+    seg_max = seg_max.scatter_reduce(0, index_, src, reduce='amax', include_self=False)
+    exp = torch.exp(src - seg_max[index])
+    seg_sum = torch.zeros(shape, dtype=src.dtype, device=src.device).index_add(0, index, exp)
+    return exp / seg_sum[index]
+
+
+def add_self_loops(edge_index, edge_weight, n_nodes):
+    """
+    Flattens batched `[B, 2, n_edges]` edges, drops the padding (weight 0)
+    and adds the self loop of every node that has an edge, weighted by
+    half its shortest edge like the dense layer. Returns the batch, source
+    and target of every edge and its weight.
+    """
+    batch_size = edge_weight.shape[0]
+    batch = torch.arange(batch_size, device=edge_weight.device).unsqueeze(1).expand_as(edge_weight)
+    valid = edge_weight != 0
+    batch, weight = batch[valid], edge_weight[valid]
+    source, target = edge_index[:, 0][valid], edge_index[:, 1][valid]
+
+    row = batch * n_nodes + source
+    row_min = torch.full((batch_size * n_nodes,), float('inf'), dtype=weight.dtype, device=weight.device)
+    row_min = row_min.scatter_reduce(0, row, weight, reduce='amin', include_self=False)
+    has_edge = torch.isfinite(row_min)
+    loops = has_edge.nonzero().squeeze(1)
+
+    batch = torch.cat((batch, loops // n_nodes))
+    source = torch.cat((source, loops % n_nodes))
+    target = torch.cat((target, loops % n_nodes))
+    weight = torch.cat((weight, row_min[loops] / 2))
+    return batch, source, target, weight
+
+
+def mask_padding(q, node_mask):
+    """ Sets the `[B, n_nodes, 1]` scores of padded nodes to -inf, so the softmax over the nodes gives them 0. """
+    if node_mask is None:
+        return q
+    return q.masked_fill(~node_mask.unsqueeze(-1), float('-inf'))
+
+
+def padding_mask(n_nodes, size):
+    """ `[B, size]` mask of the real nodes of graphs of `n_nodes[b]` nodes padded to `size`. """
+    n_nodes = torch.as_tensor(n_nodes)
+    return torch.arange(size, device=n_nodes.device).unsqueeze(0) < n_nodes.unsqueeze(-1)
+
+
+class DenseEdgeTerms(NamedTuple):
+    """ Parameter-free terms of the attention layers for `[B, n_nodes, n_nodes]` matrices. """
+    adj_norm: torch.Tensor # row-normalized weights, with the self loops
+    adj_inv: torch.Tensor # their inverse, 0 where there is no edge
+    has_edge: torch.Tensor
+
+    def split(self, n_graphs):
+        return [DenseEdgeTerms(*(t[b] for t in self)) for b in range(n_graphs)]
+
+    @staticmethod
+    def cat(terms):
+        return DenseEdgeTerms(*(torch.stack(t) for t in zip(*terms)))
+
+
+class SparseEdgeTerms(NamedTuple):
+    """ Parameter-free terms of the attention layers for batched edge lists, self loops included. """
+    batch: torch.Tensor
+    source: torch.Tensor
+    target: torch.Tensor
+    weight_norm: torch.Tensor # row-normalized weights
+    weight_inv: torch.Tensor # their inverse
+
+    def split(self, n_graphs):
+        return [SparseEdgeTerms(*(t[self.batch == b] for t in self)) for b in range(n_graphs)]
+
+    @staticmethod
+    def cat(terms):
+        counts = torch.tensor([len(t.batch) for t in terms], device=terms[0].batch.device)
+        batch = torch.repeat_interleave(torch.arange(len(terms), device=counts.device), counts)
+        return SparseEdgeTerms(batch, *(torch.cat(t) for t in list(zip(*terms))[1:]))
+
+
+def edge_terms(adj_mat, n_nodes):
+    """
+    Everything the attention layers derive from the graph alone: self
+    loops weighted by half the shortest edge of their node, row
+    normalization, inverse weights and the edge mask.
+    """
+    if isinstance(adj_mat, tuple):
+        edge_index, edge_weight = adj_mat
+        batch, source, target, weight = add_self_loops(edge_index, edge_weight, n_nodes)
+        row = batch * n_nodes + source
+        weight = weight.float()
+        row_norm = torch.zeros(edge_weight.shape[0] * n_nodes, device=weight.device).index_add(0, row, weight ** 2).sqrt()
+        return SparseEdgeTerms(batch, source, target, weight / row_norm[row], row_norm[row] / weight)
+
+    # fill node self edge and normalize, nodes without edges (e.g. padding) get none
+    d = torch.min(adj_mat.masked_fill(adj_mat == 0, float('inf')), dim=2)[0]/2
+    d = d.masked_fill(torch.isinf(d), 0)
+    nodes = torch.arange(adj_mat.shape[1], device=adj_mat.device)
+    eye = nodes.unsqueeze(0) == nodes.unsqueeze(1)
+    adj = torch.where(eye, adj_mat + d.unsqueeze(-1), adj_mat) # adj_mat + diag(d), also exportable to ONNX
+    adj_norm = f.normalize(adj.float(),p=2,dim=2)
+    adj_inv = torch.pow(adj_norm, -1)
+    has_edge = adj_inv != float('inf')
+    adj_inv[~has_edge] = 0
+    return DenseEdgeTerms(adj_norm, adj_inv, has_edge)
+
+
+def graph_views(adj_mat):
+    """ Per-graph float32 adjacency of a batch, edge lists without their padding, to tell graphs apart. """
+    if isinstance(adj_mat, tuple):
+        edge_index, edge_weight = adj_mat
+        valid = edge_weight != 0
+        return [(edge_index[b][:, valid[b]].long(), edge_weight[b][valid[b]].float()) for b in range(len(edge_weight))]
+    return list(adj_mat.float())
+
+
+def same_graph(a, b):
+    """ Whether two `graph_views` are the same graph. """
+    if isinstance(a, tuple) != isinstance(b, tuple):
+        return False
+    if isinstance(a, tuple):
+        return a[0].shape == b[0].shape and torch.equal(a[0], b[0]) and torch.equal(a[1], b[1])
+    return a.shape == b.shape and torch.equal(a, b)
+
+
+class EdgeTermCache:
+    """
+    LRU cache of `edge_terms` per graph, keyed by the graph key of the
+    instance. The adjacency of an instance does not change during an
+    episode, so these terms are computed once per graph instead of at
+    every step and learner sample. Terms are kept per key and number of
+    nodes, as a graph padded to the size of a replay bucket has other
+    dense terms. A key can still come from another graph store, e.g.
+    replay transitions of a vector env, so a hit is only used if the
+    cached adjacency equals the given one; otherwise the terms are
+    computed again and replace the cached ones.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.cache = collections.OrderedDict()
+        self.last = None # keys, graphs and batched terms of the last call, the learner runs several forwards on one batch
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, adj_mat, n_nodes, graph_ids):
+        """ `edge_terms` of the batch `adj_mat`, whose graph `b` has key `graph_ids[b]`. """
+        graph_ids = [(int(g), n_nodes) for g in graph_ids]
+        if self.last is not None and self.last[0] == graph_ids and self.last[1] is adj_mat:
+            self.hits += len(graph_ids)
+            return self.last[2]
+        views = graph_views(adj_mat)
+        missing = [b for b, g in enumerate(graph_ids) if g not in self.cache or not same_graph(self.cache[g][0], views[b])]
+        self.hits += len(graph_ids) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            if isinstance(adj_mat, tuple):
+                new_terms = edge_terms(tuple(t[missing] for t in adj_mat), n_nodes).split(len(missing))
+            else:
+                new_terms = edge_terms(adj_mat[missing], n_nodes).split(len(missing))
+            for b, terms in zip(missing, new_terms):
+                # copies, a view would keep the whole batch alive
+                view = tuple(t.clone() for t in views[b]) if isinstance(views[b], tuple) else views[b].clone()
+                self.cache[graph_ids[b]] = (view, terms)
+
+        terms = []
+        for g in graph_ids:
+            self.cache.move_to_end(g)
+            terms.append(self.cache[g][1])
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        batched = type(terms[0]).cat(terms)
+        # the learner passes the same adj_mat object to its forwards
+        self.last = (graph_ids, adj_mat, batched)
+        return batched
+
+    def clear(self):
+        self.cache.clear()
+        self.last = None
+
+    def cache_info(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.,
+                'size': len(self.cache), 'max_size': self.max_size}
+
+    def log_cache_info(self):
+        logging.info('EdgeTermCache: {hits} hits, {misses} misses ({hit_rate:.1%}), {size}/{max_size} cached'.format(**self.cache_info()))
+
+
 class GCN_Naive(nn.Module):
     def __init__(self, c_in, c_out, c_hidden):
         super(GCN_Naive, self).__init__()
@@ -40,7 +241,7 @@ class GATv2(Module):
     """
 
     def __init__(self, in_features: int, n_hidden: int, n_classes: int, n_nodes: int, n_heads: int, dropout: float,
-                 share_weights: bool = True, residual: bool = True):
+                 share_weights: bool = True, residual: bool = True, edge_encoder: str = 'mlp', edge_cache_size: int = 0):
         """
         * `in_features` is the number of features per node
         * `n_hidden` is the number of features in the first graph attention layer
@@ -48,6 +249,10 @@ class GATv2(Module):
         * `n_heads` is the number of heads in the graph attention layers
         * `dropout` is the dropout probability
         * `share_weights` if set to True, the same matrix will be applied to the source and the target node of every edge
+        * `edge_encoder` is 'mlp' for a per-edge encoder that works for any `n_nodes`,
+          or 'dense' for the `n_nodes**2 x n_nodes**2` layer of older checkpoints
+        * `edge_cache_size` is the number of graphs whose `edge_terms` are cached, 0 (the default) to disable the cache:
+          the terms are under 2% of a forward, so the cache gives no measurable speedup
         """
         super().__init__()
         self.in_features = in_features
@@ -57,16 +262,19 @@ class GATv2(Module):
         self.n_heads = n_heads
         self.share_weights = share_weights
         self.residual = residual
+        self.edge_encoder = edge_encoder
+        # terms of the graphs seen by forward(..., graph_ids), see EdgeTermCache
+        self.edge_cache = EdgeTermCache(edge_cache_size) if edge_cache_size > 0 else None
 
 
         self.linear = nn.Linear(in_features=self.in_features, out_features= self.n_hidden, bias=True)
 
         self.gat_layer = GraphAttentionV2Layer(self.n_hidden, self.n_hidden, self.n_heads,
                                                 is_concat=False, dropout=dropout, share_weights=self.share_weights,
-                                                n_nodes=self.n_nodes)
+                                                n_nodes=self.n_nodes, edge_encoder=self.edge_encoder)
         self.gat_layer2 = GraphAttentionV2Layer(2*self.n_hidden, self.n_hidden, self.n_heads,
                                                 is_concat=False, dropout=dropout, share_weights=self.share_weights,
-                                                n_nodes=self.n_nodes)
+                                                n_nodes=self.n_nodes, edge_encoder=self.edge_encoder)
 
         self.linear2 = nn.Linear(in_features=2*self.n_hidden, out_features=2*self.n_hidden, bias=True)
 
@@ -74,7 +282,9 @@ class GATv2(Module):
 
         # self.layer_norm1_h = nn.LayerNorm(self.n_hidden)
         # self.layer_norm2_h = nn.LayerNorm(self.n_hidden*2)
-        self.batch_norm1_h = nn.BatchNorm1d(self.n_node)
+        if self.edge_encoder == 'dense':
+            # unused, kept so that older checkpoints load
+            self.batch_norm1_h = nn.BatchNorm1d(self.n_nodes)
 
 
         # self.act_elu = nn.ELU()
@@ -91,7 +301,10 @@ class GATv2(Module):
         self.softmax = nn.Softmax(dim=n_classes)
 
 
-    def forward(self, x: torch.Tensor, adj_mat: torch.Tensor, mask=None):
+    def forward(self, x: torch.Tensor, adj_mat: torch.Tensor, mask=None, graph_ids=None, node_mask=None):
+        # `adj_mat` is a [batch, n_nodes, n_nodes] matrix or a batched (edge_index, edge_weight) pair
+        # `graph_ids` are the graph keys of the batch, to reuse their cached edge terms
+        # `node_mask` [batch, n_nodes] is False on the padding of graphs smaller than n_nodes
         # x[:,:,1] =x[:,:,1]/20
         # x[:,:,2] =x[:,:,2]/10
         # x[:,:,5] =x[:,:,5]/35
@@ -101,16 +314,22 @@ class GATv2(Module):
         # h_in = torch.cat((x[:,:,1:3], x[:,:,6:]), dim=2)  # for first residual connection
         # residual = torch.cat((x[:,:,1:3], x[:,:,6:8]), dim=2)
 
+        # the graph terms are shared by both attention layers
+        if graph_ids is not None and self.edge_cache is not None:
+            terms = self.edge_cache(adj_mat, x.shape[1], graph_ids)
+        else:
+            terms = edge_terms(adj_mat, x.shape[1])
+
         h_in = self.linear(x)
         # 1.[START] GAT -----------------------------------------------------------------
-        out1 = self.gat_layer(h_in, adj_mat)
+        out1 = self.gat_layer(h_in, terms)
         out1 = self.act_tahn(out1)
         out1 = torch.cat((out1, h_in), dim=2)
         # out1 = self.batch_norm1_h(out1)
         out1 = self.linear2(out1)
         out1 = self.act_tahn(out1)
 
-        out2 = self.gat_layer2(out1, adj_mat)
+        out2 = self.gat_layer2(out1, terms)
         out2 = self.act_tahn(out2)
         out2 = torch.cat((out2, out1), dim=2)
         # out2 = self.batch_norm1_h(out2)
@@ -119,12 +338,95 @@ class GATv2(Module):
 
         # 2.[START] MLP -----------------------------------------------------------------
         q = self.MLP(out2)
-        q = self.softmax(q)
+        q = self.softmax(mask_padding(q, node_mask))
         # 2.[END] MLP -----------------------------------------------------------------
 
         return q
 
 
+class GATv2EncDec(Module):
+    """
+    ## GATv2 encoder/decoder
+
+    The attention layers of `GATv2` only run on the static node features
+    (positions) and the graph, so `encode` is computed once per episode.
+    Each step then runs `decode`, which combines the node embeddings with
+    the dynamic features (visited, demand, load, trip time, trip overage)
+    and their mean over the nodes, without attention.
+    """
+
+    # rows of the environment state
+    DYNAMIC_FEATURES = [0, 1, 2, 3, 4]
+    STATIC_FEATURES = [5, 6]
+
+    def __init__(self, in_features: int, n_hidden: int, n_classes: int, n_nodes: int, n_heads: int, dropout: float,
+                 share_weights: bool = True, edge_encoder: str = 'mlp', edge_cache_size: int = 0):
+        """
+        Same arguments as `GATv2`; `in_features` must be the 7 rows of the environment state.
+        """
+        super().__init__()
+        assert in_features == len(self.DYNAMIC_FEATURES) + len(self.STATIC_FEATURES)
+        self.in_features = in_features
+        self.n_hidden = n_hidden
+        self.n_classes = n_classes
+        self.n_nodes = n_nodes
+        self.n_heads = n_heads
+        self.share_weights = share_weights
+        self.edge_encoder = edge_encoder
+        self.edge_cache = EdgeTermCache(edge_cache_size) if edge_cache_size > 0 else None
+
+        # encoder, as the attention layers of GATv2
+        self.linear = nn.Linear(in_features=len(self.STATIC_FEATURES), out_features=self.n_hidden, bias=True)
+        self.gat_layer = GraphAttentionV2Layer(self.n_hidden, self.n_hidden, self.n_heads,
+                                                is_concat=False, dropout=dropout, share_weights=self.share_weights,
+                                                n_nodes=self.n_nodes, edge_encoder=self.edge_encoder)
+        self.gat_layer2 = GraphAttentionV2Layer(2*self.n_hidden, self.n_hidden, self.n_heads,
+                                                is_concat=False, dropout=dropout, share_weights=self.share_weights,
+                                                n_nodes=self.n_nodes, edge_encoder=self.edge_encoder)
+        self.linear2 = nn.Linear(in_features=2*self.n_hidden, out_features=2*self.n_hidden, bias=True)
+        self.act_tahn = nn.Tanh()
+
+        # decoder
+        self.linear_dynamic = nn.Linear(in_features=len(self.DYNAMIC_FEATURES), out_features=self.n_hidden, bias=True)
+        self.MLP = nn.Sequential(
+            nn.Linear(in_features=5*self.n_hidden, out_features= 2*self.n_hidden, bias=True),
+            nn.ReLU(),
+            nn.Linear(in_features=2*self.n_hidden, out_features=self.n_hidden, bias=True),
+            nn.ReLU(),
+            nn.Linear(in_features=self.n_hidden, out_features=n_classes,bias=True),
+        )
+
+        self.softmax = nn.Softmax(dim=n_classes)
+
+    def encode(self, x: torch.Tensor, adj_mat: torch.Tensor, graph_ids=None):
+        """ `[batch, n_nodes, 3 * n_hidden]` node embeddings, from the positions in `x` and the graph. """
+        if graph_ids is not None and self.edge_cache is not None:
+            terms = self.edge_cache(adj_mat, x.shape[1], graph_ids)
+        else:
+            terms = edge_terms(adj_mat, x.shape[1])
+
+        h_in = self.linear(x[:, :, self.STATIC_FEATURES])
+        out1 = self.act_tahn(self.gat_layer(h_in, terms))
+        out1 = self.act_tahn(self.linear2(torch.cat((out1, h_in), dim=2)))
+        out2 = self.act_tahn(self.gat_layer2(out1, terms))
+        return torch.cat((out2, out1), dim=2)
+
+    def decode(self, x: torch.Tensor, embedding: torch.Tensor, node_mask=None):
+        """ Q-values of the state `x` of graphs whose `encode` output is `embedding`. """
+        h_dyn = self.act_tahn(self.linear_dynamic(x[:, :, self.DYNAMIC_FEATURES]))
+        if node_mask is None:
+            context = h_dyn.mean(dim=1, keepdim=True)
+        else:
+            # mean over the nodes of each graph, without its padding
+            nodes = node_mask.unsqueeze(-1).to(h_dyn.dtype)
+            context = (h_dyn * nodes).sum(dim=1, keepdim=True) / nodes.sum(dim=1, keepdim=True)
+        q = self.MLP(torch.cat((embedding, h_dyn, context.expand_as(h_dyn)), dim=2))
+        return self.softmax(mask_padding(q, node_mask))
+
+    def forward(self, x: torch.Tensor, adj_mat: torch.Tensor, mask=None, graph_ids=None, node_mask=None):
+        return self.decode(x, self.encode(x, adj_mat, graph_ids), node_mask)
+
+
 class GraphAttentionV2Layer(Module):
 
     def __init__(self, in_features: int, out_features: int, n_heads: int,
@@ -132,7 +434,9 @@ class GraphAttentionV2Layer(Module):
                  dropout: float = 0.6,
                  leaky_relu_negative_slope: float = 0.2,
                  share_weights: bool = False,
-                 n_nodes:int = 10):
+                 n_nodes:int = 10,
+                 edge_encoder: str = 'mlp',
+                 edge_hidden: int = 16):
 
         super().__init__()
         self.in_features = in_features
@@ -144,6 +448,9 @@ class GraphAttentionV2Layer(Module):
         self.dropout = dropout
         self.leaky_relu_negative_slope = leaky_relu_negative_slope
         self.share_weights = share_weights
+        if edge_encoder not in ('mlp', 'dense'):
+            raise ValueError("edge_encoder must be 'mlp' or 'dense', got {!r}".format(edge_encoder))
+        self.edge_encoder = edge_encoder
 
 
         # Calculate the number of dimensions per head
@@ -166,7 +473,16 @@ class GraphAttentionV2Layer(Module):
 
         # The activation for attention score e_ij
         self.activation = nn.Tanh() #nn.LeakyReLU(negative_slope=self.leaky_relu_negative_slope)
-        self.lin_n_node = nn.Linear(self.n_nodes**2, self.n_nodes**2, bias=False)
+        if self.edge_encoder == 'dense':
+            # mixes the inverse weights of all n_nodes**2 cells, ties the layer to n_nodes
+            self.lin_n_node = nn.Linear(self.n_nodes**2, self.n_nodes**2, bias=False)
+        else:
+            # one attention weight per head from the row-normalized travel time of each edge
+            self.edge_mlp = nn.Sequential(
+                nn.Linear(1, edge_hidden),
+                nn.Tanh(),
+                nn.Linear(edge_hidden, self.n_heads),
+            )
         # Softmax to compute attention alpha_ij
         self.softmax = nn.Softmax(dim=2)
 
@@ -174,6 +490,11 @@ class GraphAttentionV2Layer(Module):
         self.dropout = nn.Dropout(self.dropout )
 
     def forward(self, h: torch.Tensor, adj_mat: torch.Tensor, mask=None):
+        # `adj_mat` is a graph as given to GATv2.forward or its precomputed `edge_terms`
+        if not isinstance(adj_mat, (DenseEdgeTerms, SparseEdgeTerms)):
+            adj_mat = edge_terms(adj_mat, h.shape[1])
+        if isinstance(adj_mat, SparseEdgeTerms):
+            return self.forward_sparse(h, adj_mat)
 
         # Number of nodes
         batch_size = h.shape[0]
@@ -185,12 +506,8 @@ class GraphAttentionV2Layer(Module):
 
         # #### Calculate attention score
 
-        # where each node embedding is repeated `n_nodes` times.
-        g_l_repeat = g_l.repeat(1, n_nodes, 1, 1)
-        g_r_repeat_interleave = g_r.repeat_interleave(n_nodes, dim=1)
-
-        g_sum = g_l_repeat + g_r_repeat_interleave
-        g_sum = g_sum.view(batch_size, n_nodes, n_nodes, self.n_heads, self.n_hidden)
+        # g_sum[b, i, j] = g_l[b, j] + g_r[b, i], broadcast instead of repeating the embeddings `n_nodes` times
+        g_sum = g_r.unsqueeze(2) + g_l.unsqueeze(1)
 
         # `e` is of shape `[batch, n_nodes, n_nodes, n_heads, 1]`
         e = self.attn(self.activation(g_sum))
@@ -200,22 +517,20 @@ class GraphAttentionV2Layer(Module):
         # Mask $e_ij$ based on adjacency matrix.
         e_flat = torch.flatten(e, start_dim=1)
 
-        # fill node self edge and normalize
-        d = torch.min(adj_mat.masked_fill(adj_mat == 0, float('inf')), dim=2)[0]/2
-        adj = adj_mat + torch.diag_embed(d)
-        adj_norm = f.normalize(adj.float(),p=2,dim=2)
+        # self edges filled, normalized and inverted by edge_terms
+        adj_norm, adj_inv, has_edge = adj_mat
 
-        # flatten adj and invert dist
-        adj_flat = torch.flatten(adj_norm.unsqueeze(-1).repeat(1,1,1,self.n_heads), start_dim=1).to(device)
-        # e_flat = e_flat.masked_fill(adj_mat_flat == 0, float('-inf'))
-        adj_flat_inv = torch.pow(adj_flat, -1)
+        if self.edge_encoder == 'dense':
+            # flatten inverted adj
+            adj_flat_inv = torch.flatten(adj_inv.unsqueeze(-1).repeat(1,1,1,self.n_heads), start_dim=1).to(device)
 
-        # attention weighed by edge weight
-        mask_no_edge = torch.ones_like(adj_flat_inv)
-        mask_no_edge[adj_flat_inv == float('inf')] = float('0')
-
-        adj_flat_inv[adj_flat_inv == float('inf')] = float('0')
-        edge_att = self.activation(self.lin_n_node(adj_flat_inv)) * mask_no_edge
+            # attention weighed by edge weight
+            mask_no_edge = torch.flatten(has_edge.unsqueeze(-1).repeat(1,1,1,self.n_heads), start_dim=1).float().to(device)
+            edge_att = self.activation(self.lin_n_node(adj_flat_inv)) * mask_no_edge
+        else:
+            # attention weighed by edge weight, 0 where there is no edge
+            edge_att = self.activation(self.edge_mlp(adj_norm.unsqueeze(-1))) * has_edge.unsqueeze(-1)
+            edge_att = torch.flatten(edge_att, start_dim=1).to(device)
 
         e_flat = e_flat * edge_att
         e_flat = e_flat.masked_fill(e_flat == 0, float('-10000'))
@@ -249,6 +564,47 @@ class GraphAttentionV2Layer(Module):
             return attn_res.mean(dim=2)
 
 
+    def forward_sparse(self, h: torch.Tensor, terms: SparseEdgeTerms):
+        """
+        Same as `forward` for the `edge_terms` of a batched `[B, 2, n_edges]`
+        edge list and `[B, n_edges]` weights (padding edges have weight 0):
+        scores are only computed on edges and self loops and normalized with
+        a scatter softmax. A node without edges gets a zero output (NaN in
+        the dense layer).
+        """
+        batch_size = h.shape[0]
+        n_nodes = h.shape[1]
+
+        g_l = self.linear_l(h).view(batch_size, n_nodes, self.n_heads, self.n_hidden)
+        g_r = self.linear_r(h).view(batch_size, n_nodes, self.n_heads, self.n_hidden)
+
+        batch, source, target, weight_norm, weight_inv = terms
+        row = batch * n_nodes + source
+
+        # e_ij = attn(act(g_l[j] + g_r[i])) on edges only
+        e = self.attn(self.activation(g_l[batch, target] + g_r[batch, source])).squeeze(-1)
+
+        if self.edge_encoder == 'dense':
+            # lin_n_node mixes all (i, j) cells of the inverse weights, the ones without an edge are 0
+            cell = source * n_nodes + target
+            cells = torch.zeros(batch_size, n_nodes * n_nodes, device=h.device).index_put((batch, cell), weight_inv)
+            edge_att = self.activation(self.lin_n_node(cells))[batch, cell].unsqueeze(-1)
+        else:
+            edge_att = self.activation(self.edge_mlp(weight_norm.unsqueeze(-1)))
+
+        e = e * edge_att
+        e = e.masked_fill(e == 0, float('-10000'))
+
+        a = self.dropout(scatter_softmax(e, row, batch_size * n_nodes))
+        attn_res = torch.zeros(batch_size * n_nodes, self.n_heads, self.n_hidden, dtype=g_r.dtype, device=h.device)
+        attn_res = attn_res.index_add(0, row, a.unsqueeze(-1) * g_r[batch, target]).view(batch_size, n_nodes, self.n_heads, self.n_hidden)
+
+        if self.is_concat:
+            return attn_res.reshape(batch_size, n_nodes, self.n_heads * self.n_hidden)
+        else:
+            return attn_res.mean(dim=2)
+
+
 def test_GATv2():
     dim_in = 8+4
     model = GATv2(in_features=dim_in, n_hidden=dim_in*2, n_classes=1, n_heads=1, dropout=0.1, share_weights=False)
@@ -0,0 +1,47 @@
+import numpy as np
+import onnxruntime as ort
+
+"""
+Greedy action selection with a policy network exported by
+`python policy.py export`, run by onnxruntime. Only numpy and
+onnxruntime are imported, so a routing service does not need torch or
+the training code.
+"""
+
+NEG_INF = -100000 # DQAgent.neg_inf, added to the Q-value of masked nodes
+
+
+class OnnxPolicy:
+    """
+    Policy network exported to ONNX, callable like `policy_net(x, adj)` on
+    `[batch, n_nodes, n_features]` states and dense `[batch, n_nodes, n_nodes]`
+    graphs, given as arrays or CPU tensors. Returns the `[batch, n_nodes, 1]`
+    Q-values as an array.
+
+    `intra_op_num_threads` and `inter_op_num_threads` size the onnxruntime
+    thread pools, 0 lets onnxruntime choose.
+    """
+
+    # edge lists are not part of the exported graph
+    dense_only = True
+
+    def __init__(self, path, intra_op_num_threads=0, inter_op_num_threads=0):
+        self.path = path
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_num_threads
+        options.inter_op_num_threads = inter_op_num_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.adj_dtype = np.float32 if self.session.get_inputs()[1].type == 'tensor(float)' else np.float64
+
+    def __call__(self, x, adj, mask=None, graph_ids=None):
+        inputs = {'x': np.asarray(x, dtype=np.float32), 'adj': np.asarray(adj, dtype=self.adj_dtype)}
+        return self.session.run(['q'], inputs)[0]
+
+    def choose_action(self, state, adj, mask):
+        """
+        Greedy action of `DQAgent.choose_action` for an environment state
+        `[n_features, n_nodes]`, its graph `[n_nodes, n_nodes]` and mask `[1, n_nodes]`.
+        """
+        q = self(np.asarray(state).T[None], np.asarray(adj)[None])
+        return int(np.argmax(q[0, :, 0] + (1 - np.asarray(mask)[0]) * NEG_INF))
@@ -0,0 +1,274 @@
+import argparse
+import copy
+import hashlib
+import io
+import logging
+import os
+import time
+import warnings
+
+import numpy as np
+import torch
+
+"""
+Inference copies of the policy network, for acting only.
+
+`compile_policy` traces a `GATv2` with TorchScript for a fixed number of
+nodes, checks it against the eager model and caches the trace on disk,
+keyed by the weights. `DQAgent.compile_inference` uses it in
+`choose_action`. `quantize_policy` makes a copy with dynamically
+quantized int8 linear layers, see `DQAgent.load_model(quantize=True)`.
+`export_onnx` writes the network as an ONNX graph for
+`onnx_policy.OnnxPolicy`. From the command line:
+
+    python policy.py compile --model_path model.pt --n_nodes 20
+    python policy.py quantize --model_path model.pt --n_nodes 20
+    python policy.py export --model_path model.pt --output policy.onnx
+"""
+
+CACHE_DIR = os.path.join('trained_models', 'compiled')
+MIN_AGREEMENT = 0.99 # greedy actions an int8 copy must share with its float network, see DQAgent.load_model
+
+
+def policy_key(net, n_nodes):
+    """ Hash of the network class, `n_nodes`, the torch version and the weights. """
+    h = hashlib.sha1('{}:{}:{}'.format(type(net).__name__, n_nodes, torch.__version__).encode())
+    for name, tensor in net.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def example_inputs(n_nodes, n_features=7, seed=0):
+    """ A random state and a random weighted graph (half of the edges missing), batch of 1. """
+    gen = torch.Generator().manual_seed(seed)
+    x = torch.rand(1, n_nodes, n_features, generator=gen)
+    adj = torch.rand(1, n_nodes, n_nodes, generator=gen, dtype=torch.float64)
+    adj = adj * (torch.rand(1, n_nodes, n_nodes, generator=gen) < 0.5) * (1 - torch.eye(n_nodes, dtype=torch.float64))
+    return x, adj
+
+
+def _copy_without_cache(net):
+    """ Deep copy of `net` in eval mode, without its edge term cache. """
+    edge_cache, net.edge_cache = net.edge_cache, None
+    try:
+        return copy.deepcopy(net).eval()
+    finally:
+        net.edge_cache = edge_cache
+
+
+def check_parity(net, compiled, n_nodes, n_samples=16, atol=1e-5):
+    """ Largest difference between the eager and compiled Q-values on random inputs; raises if above `atol`. """
+    net_mode = net.training
+    net.eval()
+    max_diff = 0.
+    with torch.no_grad():
+        for seed in range(n_samples):
+            x, adj = example_inputs(n_nodes, net.in_features, seed=seed + 1)
+            max_diff = max(max_diff, (net(x, adj) - compiled(x, adj)).abs().max().item())
+    net.train(net_mode)
+    if not max_diff <= atol:
+        raise RuntimeError('compiled policy differs from the eager one by {:.2e} (atol {:.0e})'.format(max_diff, atol))
+    return max_diff
+
+
+def action_agreement(net, other, n_nodes, n_samples=64):
+    """ Fraction of random inputs on which `other` picks the same greedy node as `net`. """
+    net_mode = net.training
+    net.eval()
+    same = 0
+    with torch.no_grad():
+        for seed in range(n_samples):
+            x, adj = example_inputs(n_nodes, net.in_features, seed=seed + 1)
+            same += int(net(x, adj)[0, :, 0].argmax() == torch.as_tensor(other(x, adj))[0, :, 0].argmax())
+    net.train(net_mode)
+    return same / n_samples
+
+
+def compile_policy(net, n_nodes, cache_dir=CACHE_DIR, check=True):
+    """
+    TorchScript trace of `net` in eval mode for graphs of `n_nodes` nodes
+    given as dense `[1, n_nodes, n_nodes]` matrices. The trace is loaded
+    from `cache_dir` when the same weights were compiled before.
+    It holds a copy of the weights, so it is stale once `net` is trained.
+    """
+    path = os.path.join(cache_dir, '{}_{}_{}.pt'.format(type(net).__name__, n_nodes, policy_key(net, n_nodes)[:16]))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning) # torch.jit deprecation notices
+        if os.path.isfile(path):
+            logging.info('Loading compiled policy {}'.format(path))
+            compiled = torch.jit.load(path)
+        else:
+            # the edge term cache is not part of the trace
+            frozen = _copy_without_cache(net)
+            with torch.no_grad():
+                compiled = torch.jit.trace(frozen, example_inputs(n_nodes, net.in_features), check_trace=False)
+            compiled = torch.jit.optimize_for_inference(torch.jit.freeze(compiled))
+            os.makedirs(cache_dir, exist_ok=True)
+            torch.jit.save(compiled, path)
+            logging.info('Saved compiled policy {}'.format(path))
+
+    if check:
+        check_parity(net, compiled, n_nodes)
+    return compiled
+
+
+def quantize_policy(net):
+    """
+    Copy of `net` in eval mode whose linear layers have int8 weights and
+    quantize their input on the fly (`quantize_dynamic`). The attention
+    scores `attn`, applied to n_nodes**2 rows, and the edge MLP, which has
+    a single input, stay in float: quantizing their inputs costs more than
+    it saves. The copy shares the edge term cache of `net`.
+    """
+    layers = {name for name, module in net.named_modules()
+              if isinstance(module, torch.nn.Linear) and 'edge_mlp' not in name and not name.endswith('attn')}
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning) # torch.ao.quantization moves to torchao
+        warnings.simplefilter('ignore', UserWarning)
+        quantized = torch.ao.quantization.quantize_dynamic(_copy_without_cache(net), layers, dtype=torch.qint8)
+    quantized.edge_cache = net.edge_cache
+    return quantized
+
+
+def export_onnx(net, path, n_nodes=None):
+    """
+    Writes `net` in eval mode as an ONNX graph with inputs `x`
+    `[batch, n_nodes, n_features]` and `adj` `[batch, n_nodes, n_nodes]`
+    (float64) and output `q` `[batch, n_nodes, 1]`. The batch and node
+    axes are dynamic, except the node axis of the 'dense' edge encoder,
+    which is fixed to `net.n_nodes`.
+    """
+    n_nodes = net.n_nodes if n_nodes is None else n_nodes
+    batch = torch.export.Dim('batch')
+    nodes = torch.export.Dim('nodes', min=2) if net.edge_encoder == 'mlp' else None
+    dynamic_shapes = ({0: batch, 1: nodes}, {0: batch, 1: nodes, 2: nodes})
+    x, adj = example_inputs(n_nodes, net.in_features)
+    for name in ('onnxscript', 'onnx_ir'): # one line per optimization pass at INFO
+        logging.getLogger(name).setLevel(logging.WARNING)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        torch.onnx.export(_copy_without_cache(net), (x.repeat(2, 1, 1), adj.repeat(2, 1, 1)), path, dynamo=True,
+                          input_names=['x', 'adj'], output_names=['q'], dynamic_shapes=dynamic_shapes, verbose=False)
+    return path
+
+
+def check_onnx_parity(net, onnx_net, sizes, batch_size=4, atol=1e-5):
+    """ Largest difference between `net` and an `OnnxPolicy` over batches of graphs of each size; raises if above `atol`. """
+    net_mode = net.training
+    net.eval()
+    max_diff = 0.
+    with torch.no_grad():
+        for n_nodes in sizes:
+            x, adj = zip(*(example_inputs(n_nodes, net.in_features, seed=seed + 1) for seed in range(batch_size)))
+            x, adj = torch.cat(x), torch.cat(adj)
+            max_diff = max(max_diff, np.abs(net(x, adj).numpy() - onnx_net(x, adj)).max())
+    net.train(net_mode)
+    if not max_diff <= atol:
+        raise RuntimeError('ONNX policy differs from the eager one by {:.2e} (atol {:.0e})'.format(max_diff, atol))
+    return max_diff
+
+
+def state_dict_mb(net):
+    """ Size of the serialized weights of `net`. """
+    buffer = io.BytesIO()
+    torch.save(net.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+
+def route_parity(agent, env, graph_ids, max_iter=1000):
+    """
+    Greedy episodes of `agent` on `graph_ids` with its float policy
+    network and with its `inference_net`; returns the fraction of
+    identical routes and the rewards of both.
+    """
+    from runner import Runner
+    runner = Runner(env, agent)
+    inference_net, epsilon = agent.inference_net, agent.epsilon_
+    agent.epsilon_ = 0
+    results = {}
+    try:
+        for name, net in (('float', None), ('inference', inference_net)):
+            agent.inference_net = net
+            agent.clear_edge_cache()
+            results[name] = [runner.validate(g, max_iter, verbose=False, return_route=True) for g in graph_ids]
+    finally:
+        agent.inference_net, agent.epsilon_ = inference_net, epsilon
+    same = np.mean([a[1] == b[1] for a, b in zip(results['float'], results['inference'])])
+    return same, np.array([r for r, _ in results['float']]), np.array([r for r, _ in results['inference']])
+
+
+def latency(fn, n_nodes, n_features=7, n_decisions=200):
+    """ p50 and p99 in ms of `fn(x, adj)` on batches of one state. """
+    inputs = [example_inputs(n_nodes, n_features, seed=seed) for seed in range(16)]
+    times = []
+    with torch.no_grad():
+        for x, adj in inputs:
+            fn(x, adj) # warm up
+        for i in range(n_decisions):
+            x, adj = inputs[i % len(inputs)]
+            start = time.perf_counter()
+            fn(x, adj)
+            times.append(time.perf_counter() - start)
+    return 1e3 * np.percentile(times, 50), 1e3 * np.percentile(times, 99)
+
+
+def latency_report(net, inference_net, n_nodes, n_decisions=200, name='compiled'):
+    net.eval()
+    for name, fn in (('eager', net), (name, inference_net)):
+        p50, p99 = latency(fn, n_nodes, net.in_features, n_decisions)
+        print('{:8} p50 {:7.3f} ms, p99 {:7.3f} ms per decision'.format(name, p50, p99))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Policy network tools')
+    parser.add_argument('command', choices=['compile', 'quantize', 'export'])
+    parser.add_argument('--model', type=str, default='GATv2', help='GATv2 or GATv2_encdec')
+    parser.add_argument('--model_path', type=str, default=None, help='state dict to load, random weights if not given')
+    parser.add_argument('--n_nodes', type=int, default=10)
+    parser.add_argument('--n_features', type=int, default=7)
+    parser.add_argument('--cache_dir', type=str, default=CACHE_DIR)
+    parser.add_argument('--output', type=str, default='policy.onnx', help='ONNX file written by export')
+    parser.add_argument('--n_decisions', type=int, default=200, help='number of timed decisions')
+    parser.add_argument('--n_graphs', type=int, default=100, help='instances of the quantize parity report')
+    parser.add_argument('--seed', type=int, default=121, help='base seed of these instances, main.py validates on seed + 1')
+    args = parser.parse_args()
+
+    from agent import DQAgent
+    # only the networks are used; max_edges=0 stores edge lists of no edges, so the replay buffer holds no n_nodes x n_nodes matrices
+    agent = DQAgent(args.model, 1e-4, 32, 100, args.n_nodes, args.n_features, max_edges=0)
+    if args.model_path is not None:
+        agent.load_model(args.model_path)
+
+    if args.command == 'compile':
+        compiled = compile_policy(agent.policy_net, args.n_nodes, args.cache_dir, check=False)
+        print('max |eager - compiled| = {:.2e}'.format(check_parity(agent.policy_net, compiled, args.n_nodes)))
+        latency_report(agent.policy_net, compiled, args.n_nodes, args.n_decisions)
+
+    elif args.command == 'quantize':
+        from environment import Environment
+        from graph import generate_graphs
+        # main.py defaults
+        graph_dict = generate_graphs(args.n_graphs, base_seed=args.seed, n_nodes=args.n_nodes, k_nn=5, n_vehicles=3,
+                                     penalty_cost_demand=5., penalty_cost_time=5., speed=30., time_limit=35.)
+        env = Environment(graph_dict, 'bss', verbose=False, penalty_unvisited=2)
+        agent.inference_net = quantize_policy(agent.policy_net)
+        same, r_float, r_int8 = route_parity(agent, env, list(graph_dict))
+        print('{} instances: {:.1%} identical greedy routes'.format(args.n_graphs, same))
+        print('mean reward: float {:.4f}, int8 {:.4f}, max |difference| {:.4f}'.format(
+            r_float.mean(), r_int8.mean(), np.abs(r_float - r_int8).max()))
+        agreement = action_agreement(agent.policy_net, agent.inference_net, args.n_nodes)
+        print('greedy action agreement on random states {:.1%}, {} by DQAgent.load_model(quantize=True) (needs {:.0%})'.format(
+            agreement, 'accepted' if agreement >= MIN_AGREEMENT else 'refused', MIN_AGREEMENT))
+        print('weights: float {:.2f} MB, int8 {:.2f} MB'.format(state_dict_mb(agent.policy_net), state_dict_mb(agent.inference_net)))
+        latency_report(agent.policy_net, agent.inference_net, args.n_nodes, args.n_decisions, name='int8')
+
+    elif args.command == 'export':
+        from onnx_policy import OnnxPolicy
+        export_onnx(agent.policy_net, args.output, args.n_nodes)
+        onnx_net = OnnxPolicy(args.output)
+        sizes = [args.n_nodes] if agent.policy_net.edge_encoder == 'dense' else [args.n_nodes, 2 * args.n_nodes]
+        print('Wrote {}, max |eager - onnxruntime| = {:.2e} for {} nodes'.format(
+            args.output, check_onnx_parity(agent.policy_net, onnx_net, sizes), sizes))
+        latency_report(agent.policy_net, onnx_net, args.n_nodes, args.n_decisions, name='onnx')
@@ -29,13 +29,15 @@ class ReplayMemory(object):
 
 # replay option 2 with PER
 class ReplayBuffer:
-    def __init__(self, capacity, alpha, n_nodes, n_features):
+    def __init__(self, capacity, alpha, n_nodes, n_features, max_edges=None):
         # We use a power of 2 for capacity because it simplifies the code and debugging
         self.capacity = capacity
         self.alpha = alpha
         self.n_nodes = n_nodes
         self.n_features = n_features
-       
+        # with max_edges, graphs are stored as edge lists padded to max_edges instead of n_nodes x n_nodes matrices
+        self.max_edges = max_edges
+
 
         # Maintain segment binary trees to take sum and find minimum over a range
         self.priority_sum = [0 for _ in range(2 * self.capacity)]
@@ -49,8 +51,15 @@ class ReplayBuffer:
             'action': np.zeros(shape=capacity, dtype=np.int64),
             'reward': np.zeros(shape=capacity, dtype=np.float32),
             'next_obs': np.zeros(shape=(capacity, self.n_features, self.n_nodes), dtype=np.float32),
-            'adj': np.zeros(shape=(capacity, self.n_nodes, self.n_nodes), dtype=np.float32),
+            'graph': np.full(shape=capacity, fill_value=-1, dtype=np.int64), # graph key, -1 if unknown
+            'n_nodes': np.full(shape=capacity, fill_value=self.n_nodes, dtype=np.int64), # nodes before the padding
         }
+        if self.max_edges is None:
+            self.data['adj'] = np.zeros(shape=(capacity, self.n_nodes, self.n_nodes), dtype=np.float32)
+        else:
+            # padding edges are (0, 0) with weight 0, i.e. no edge
+            self.data['edge_index'] = np.zeros(shape=(capacity, 2, self.max_edges), dtype=np.int32)
+            self.data['edge_weight'] = np.zeros(shape=(capacity, self.max_edges), dtype=np.float32)
 
         # We use cyclic buffers to store data, and `next_idx` keeps the index of the next empty slot
         self.next_idx = 0
@@ -58,16 +67,26 @@ class ReplayBuffer:
         # Size of the buffer
         self.size = 0
 
-    def add(self, obs, action, reward, next_obs, adj):
+    def add(self, obs, action, reward, next_obs, adj, graph_id=-1):
         # Get next available slot
         idx = self.next_idx
 
-        # store in the queue
-        self.data['obs'][idx] = obs
+        # store in the queue, graphs with fewer than n_nodes nodes are zero padded
+        self._put('obs', idx, obs)
         self.data['action'][idx] = action
         self.data['reward'][idx] = reward
-        self.data['next_obs'][idx] = next_obs
-        self.data['adj'][idx] = adj
+        self._put('next_obs', idx, next_obs)
+        self.data['graph'][idx] = graph_id
+        self.data['n_nodes'][idx] = obs.shape[-1]
+        if self.max_edges is None:
+            self._put('adj', idx, adj)
+        else:
+            edge_index, edge_weight = adj
+            n_edges = edge_weight.shape[0]
+            self.data['edge_index'][idx, :, :n_edges] = edge_index
+            self.data['edge_index'][idx, :, n_edges:] = 0
+            self.data['edge_weight'][idx, :n_edges] = edge_weight
+            self.data['edge_weight'][idx, n_edges:] = 0
 
         # Increment next available slot
         self.next_idx = (idx + 1) % self.capacity
@@ -82,6 +101,13 @@ class ReplayBuffer:
         self._set_priority_min(idx, priority_alpha)
         self._set_priority_sum(idx, priority_alpha)
 
+    def _put(self, key, idx, value):
+        slot = self.data[key][idx]
+        if slot.shape != tuple(value.shape):
+            slot[...] = 0
+            slot = slot[tuple(slice(0, n) for n in value.shape)]
+        slot[...] = value
+
     def _set_priority_min(self, idx, priority_alpha):
 
         # Leaf of the binary tree
@@ -173,3 +199,73 @@ class ReplayBuffer:
 
     def is_full(self):
         return self.capacity == self.size
+
+
+# replay option 3, PER over graphs of several sizes
+class BucketedReplayBuffer:
+    """
+    Prioritized replay for graphs of different sizes: a transition is
+    stored in the `ReplayBuffer` of the smallest bucket in `node_buckets`
+    that fits its graph, zero padded to the bucket size. A batch is drawn
+    from one bucket, picked with probability proportional to its total
+    priority, so it is only padded to the largest graph of its bucket.
+    The `n_nodes` field of a sample gives the real size of each graph.
+    """
+
+    def __init__(self, capacity, alpha, node_buckets, n_features, max_edges=None):
+        self.node_buckets = sorted(node_buckets)
+        # every bucket gets the same power of 2 share of the capacity
+        self.bucket_capacity = 2 ** int(np.log2(capacity // len(self.node_buckets)))
+        self.capacity = self.bucket_capacity * len(self.node_buckets)
+        self.alpha = alpha
+        self.n_nodes = self.node_buckets[-1]
+        self.buckets = [ReplayBuffer(self.bucket_capacity, alpha, n, n_features, max_edges) for n in self.node_buckets]
+
+    @property
+    def size(self):
+        return sum(b.size for b in self.buckets)
+
+    def bucket(self, n_nodes):
+        """ Index of the bucket that stores graphs of `n_nodes` nodes. """
+        for i, n in enumerate(self.node_buckets):
+            if n_nodes <= n:
+                return i
+        raise ValueError('graph of {} nodes does not fit the largest bucket ({} nodes)'.format(n_nodes, self.n_nodes))
+
+    def add(self, obs, action, reward, next_obs, adj, graph_id=-1):
+        self.buckets[self.bucket(obs.shape[-1])].add(obs, action, reward, next_obs, adj, graph_id)
+
+    def _sum(self):
+        return sum(b._sum() for b in self.buckets)
+
+    def sample(self, batch_size, beta):
+        # pick a bucket by its share of the priorities, then sample within it
+        sums = [b._sum() for b in self.buckets]
+        p = random.random() * sum(sums)
+        i = 0
+        while i < len(sums) - 1 and p >= sums[i]: # empty buckets have a zero sum
+            p -= sums[i]
+            i += 1
+        bucket = self.buckets[i]
+        samples = bucket.sample(batch_size, beta)
+
+        # importance weights over the whole buffer, as if it was one ReplayBuffer
+        total = sum(sums)
+        prob_min = min(b._min() for b in self.buckets) / total
+        max_weight = (prob_min * self.size) ** (-beta)
+        prob = np.array([bucket.priority_sum[idx + bucket.capacity] for idx in samples['indexes']]) / total
+        samples['weights'] = ((prob * self.size) ** (-beta) / max_weight).astype(np.float32)
+        samples['indexes'] = samples['indexes'] + i * self.bucket_capacity
+        return samples
+
+    def update_priorities(self, indexes, priorities):
+        for idx, priority in zip(indexes, priorities):
+            i, idx = divmod(int(idx), self.bucket_capacity)
+            self.buckets[i].update_priorities([idx], [priority])
+        # new transitions of every bucket get the highest priority seen
+        max_priority = max(b.max_priority for b in self.buckets)
+        for b in self.buckets:
+            b.max_priority = max_priority
+
+    def is_full(self):
+        return all(b.is_full() for b in self.buckets)
@@ -38,8 +38,7 @@ class Runner:
 
             for i in range(0, max_iter):
                 mask = mask.to(device)
-                a, _ = self.agent.choose_action(s, adj_mat, mask)
-                #a, q_a = self.agent.choose_action(s, adj_mat, mask)
+                a, q_a = self.agent.choose_action(s, adj_mat, mask, graph_id=g)
 				
                 # obtain the reward and next state and some other information
                 s_, r, done, info = self.env.step(a)
@@ -52,7 +51,7 @@ class Runner:
 
                 # # Store the transition in memory
                 # self.agent.memory.push(s, a, r, s_, adj_mat, mask)
-                self.agent.replay_buffer.add(s, a, r, s_, adj_mat)
+                self.agent.replay_buffer.add(s, a, r, s_, adj_mat, graph_id=g)
                 self.agent.memory_counter += 1
 
                 ep_r += r.item()
@@ -101,6 +100,95 @@ class Runner:
 
         return reward_list, loss_list, epsilon_list, iter_count
 
+    def act(self, s, adj_mat, mask, graphs):
+        """ Chooses one action per env of a `SubprocVectorEnv` batch. """
+        return self.agent.choose_actions(s, adj_mat, mask, graph_ids=graphs).tolist()
+
+    def train_async(self, vec_env, n_episodes, writer=None):
+        """
+        Collects experience and learns from a `SubprocVectorEnv` until
+        `n_episodes` episodes have finished, over all envs. The envs are
+        split in two groups: while the workers of one group step, the agent
+        chooses actions and learns on the other one. Like `train_loop`, the
+        learning rate decays once per game, i.e. every `vec_env.n_episodes`
+        finished episodes, and the rewards and losses go to tensorboard and
+        `rl_results/`.
+        """
+        self.agent.policy_net.train() # dropout/BN train mode
+        self.agent.target_net.train() # dropout/BN train mode
+        self.agent.clear_edge_cache() # graph keys refer to the graphs of vec_env
+        close_writer = writer is None
+        if writer is None:
+            writer = SummaryWriter()
+
+        reward_list = []
+        loss_list = []
+        epsilon_list = []
+        iter_count = 0 # episode counter for tensorboard
+        ep_r = np.zeros(vec_env.n_envs)
+        ep_loss = [[] for _ in range(vec_env.n_envs)]
+        ep_eps = [[] for _ in range(vec_env.n_envs)]
+
+        pending = []
+        for group in vec_env.split(2):
+            s, adj_mat, mask = vec_env.reset(group)
+            graphs = vec_env.graphs(group).clone()
+            a = self.act(s, adj_mat, mask, graphs)
+            vec_env.step_async(a, group)
+            pending.append((group, s, adj_mat, graphs, a))
+
+        while iter_count < n_episodes:
+            group, s, adj_mat, graphs, a = pending.pop(0)
+            s_, r, done, info = vec_env.step_wait(group)
+
+            for b, env_id in enumerate(range(vec_env.n_envs)[group]):
+                next_s = info['final_obs'][b] if done[b] else s_[b]
+                self.agent.replay_buffer.add(s[b], a[b], r[b].item(), next_s, adj_mat[b], graph_id=graphs[b].item())
+                self.agent.memory_counter += 1
+                self.step_cnt += 1
+                ep_r[env_id] += r[b].item()
+
+                if self.agent.memory_counter > self.agent.mem_capacity:
+                    loss, epsilon = self.agent.learn(iter_count)
+                    ep_loss[env_id].append(loss.item())
+                    ep_eps[env_id].append(epsilon)
+
+                if done[b] and iter_count < n_episodes:
+                    reward_list.append(ep_r[env_id]*500)
+                    loss_avg = np.mean(ep_loss[env_id]) if ep_loss[env_id] else np.nan
+                    eps_avg = np.mean(ep_eps[env_id]) if ep_eps[env_id] else np.nan
+                    if ep_loss[env_id]:
+                        loss_list.append(loss_avg)
+                        epsilon_list.append(eps_avg)
+                    writer.add_scalar("ep_r", ep_r[env_id]*500, iter_count)
+                    writer.add_scalar('loss_avg', loss_avg, iter_count)
+                    writer.add_scalar('eps_avg', eps_avg, iter_count)
+                    ep_r[env_id] = 0
+                    ep_loss[env_id], ep_eps[env_id] = [], []
+                    iter_count += 1
+
+                    if iter_count % vec_env.n_episodes == 0: # one game
+                        self.agent.scheduler.step()
+                        if self.agent.policy_net.edge_cache is not None:
+                            writer.add_scalar('edge_cache_hit_rate', self.agent.policy_net.edge_cache.cache_info()['hit_rate'], iter_count)
+
+            # act on the new observations while the other group is stepping
+            graphs = info['graph'].clone()
+            a = self.act(s_, info['adj'], info['mask'], graphs)
+            vec_env.step_async(a, group)
+            pending.append((group, s_, info['adj'], graphs, a))
+
+        for group, _, _, _, _ in pending:
+            vec_env.step_wait(group)
+
+        pickle.dump(reward_list, open('rl_results/reward_{}.pkl'.format(timestamp()), 'wb'))
+        pickle.dump(loss_list, open('rl_results/loss_{}.pkl'.format(timestamp()), 'wb'))
+        if self.agent.policy_net.edge_cache is not None:
+            self.agent.policy_net.edge_cache.log_cache_info()
+        if close_writer:
+            writer.close()
+        return reward_list, loss_list, epsilon_list
+
     def train_loop(self, games, max_epoch, max_episode=30, max_iter=1000):
         writer = SummaryWriter()
         cumul_reward_list = []
@@ -108,6 +196,7 @@ class Runner:
         cumul_epsilon_list = []
         CHECK =1000
         itr_count = 0 # episode counter for tensorboard
+        self.agent.clear_edge_cache() # graph keys refer to the graphs of self.env
         # Start training
         print("\nCollecting experience...")
         for epoch_ in range(max_epoch):
@@ -119,6 +208,8 @@ class Runner:
                 cumul_loss_list.extend(loss_list)
                 cumul_epsilon_list.extend(epsilon_list)
                 self.agent.scheduler.step()
+                if self.agent.policy_net.edge_cache is not None:
+                    writer.add_scalar('edge_cache_hit_rate', self.agent.policy_net.edge_cache.cache_info()['hit_rate'], itr_count)
 
 
                 if self.plot_on:
@@ -138,6 +229,9 @@ class Runner:
         #pickle.dump(self.q_a, open('rl_results/q_a{}.pkl'.format(timestamp()), 'wb'))
 
 
+        if self.agent.policy_net.edge_cache is not None:
+            self.agent.policy_net.edge_cache.log_cache_info()
+
         plot_reward(cumul_reward_list)
         plot_loss(cumul_loss_list)
         self.env.render()
@@ -153,7 +247,7 @@ class Runner:
         route = [0]
 
         for i in range(0, max_iter):
-            a, _ = self.agent.choose_action(s, adj_mat, mask)
+            a, _ = self.agent.choose_action(s, adj_mat, mask, graph_id=g)
             route.append(a.item())
             s_, r, done, info = self.env.step(a)
 
@@ -179,6 +273,7 @@ class Runner:
 
     def validate_loop(self, games, max_iter=1000):
         self.agent.epsilon_ = 0
+        self.agent.clear_edge_cache() # graph keys refer to the graphs of self.env
         reward_list = []
         for g in range(games):
             print(" -> games : " + str(g))
@@ -188,4 +283,7 @@ class Runner:
             with open('val_result.pickle', 'wb') as handle:
                 pickle.dump(reward_list, handle)
 
+        if self.agent.policy_net.edge_cache is not None:
+            self.agent.policy_net.edge_cache.log_cache_info()
+
         return reward_list
\ No newline at end of file
@@ -0,0 +1,69 @@
+"""
+`DQAgent.choose_actions` against one `choose_action` per environment.
+"""
+import numpy as np
+import torch
+
+import agent
+from environment import Environment
+from utils.benchmark import make_graphs, random_actions, batch_edges
+
+
+def greedy_agent(n_nodes, seed=0):
+    torch.manual_seed(seed)
+    dqn = agent.Agent('GATv2', 1e-4, 8, 100, n_nodes, 7, max_edges=0)
+    dqn.epsilon_ = 0
+    dqn.policy_net.eval()
+    return dqn
+
+
+def play(graph_dict, n_steps=1, seed=0, sparse=False):
+    """ States, adjacencies and masks of each graph after `n_steps` random steps, several nodes still feasible. """
+    rng = np.random.RandomState(seed)
+    states, adjs, masks = [], [], []
+    for g in graph_dict:
+        env = Environment(graph_dict, 'bss', verbose=False, sparse=sparse)
+        s, adj, mask = env.reset(g)
+        for _ in range(n_steps):
+            s, _, _, info = env.step(int(random_actions(mask, rng)[0]))
+            mask = info[3]
+        states.append(s)
+        adjs.append(adj)
+        masks.append(mask)
+    return states, adjs, masks
+
+
+def test_choose_actions_matches_choose_action_dense():
+    graph_dict = make_graphs(6, 10)
+    dqn = greedy_agent(10)
+    states, adjs, masks = play(graph_dict)
+    actions = dqn.choose_actions(torch.stack(states), torch.stack(adjs), torch.cat(masks))
+    for b in range(len(states)):
+        assert actions[b] == dqn.choose_action(states[b], adjs[b], masks[b])[0].item()
+
+
+def test_choose_actions_matches_choose_action_edge_lists():
+    graph_dict = make_graphs(6, 10)
+    dqn = greedy_agent(10)
+    states, adjs, masks = play(graph_dict, sparse=True)
+    actions = dqn.choose_actions(torch.stack(states), batch_edges(list(graph_dict.values())), torch.cat(masks))
+    for b in range(len(states)):
+        assert actions[b] == dqn.choose_action(states[b], adjs[b], masks[b])[0].item()
+
+
+def test_choose_actions_matches_choose_action_padded():
+    sizes, size = (10, 16, 12), 16
+    graph_dict = {i: g for i, n in enumerate(sizes) for g in make_graphs(1, n, seed=i).values()}
+    dqn = greedy_agent(size)
+    states, adjs, masks = play(graph_dict)
+    padded_states = torch.zeros(len(sizes), 7, size)
+    padded_adj = torch.zeros(len(sizes), size, size, dtype=adjs[0].dtype)
+    padded_masks = torch.zeros(len(sizes), size, dtype=masks[0].dtype)
+    for b, n in enumerate(sizes):
+        padded_states[b, :, :n] = states[b]
+        padded_adj[b, :n, :n] = adjs[b]
+        padded_masks[b, :n] = masks[b]
+    actions = dqn.choose_actions(padded_states, padded_adj, padded_masks, n_nodes=list(sizes))
+    for b, n in enumerate(sizes):
+        assert actions[b] < n
+        assert actions[b] == dqn.choose_action(states[b], adjs[b], masks[b])[0].item()
@@ -0,0 +1,63 @@
+"""
+Parity of the environment fast paths with a plain `Environment`, on small
+seeded instances.
+"""
+import copy
+
+import numpy as np
+import pytest
+import torch
+
+import env_backends
+from environment import Environment
+from utils.benchmark import make_graphs, random_actions, record_actions, check_batched_parity
+
+
+def test_batched_environment_matches_environment():
+    assert check_batched_parity(make_graphs(4, 10), n_steps=300) > 0
+
+
+@pytest.mark.skipif(env_backends.numba is None, reason='numba is not installed')
+def test_numba_backend_matches_numpy():
+    graph_dict = make_graphs(1, 20)
+    actions = record_actions(graph_dict, 0, n_episodes=5)
+    envs = [Environment(graph_dict, 'bss', verbose=False, backend=backend) for backend in ('numpy', 'numba')]
+    for env in envs:
+        env.reset(0)
+    for action in actions:
+        (s, r, d, info), (s_ref, r_ref, d_ref, info_ref) = [env.step(action) for env in envs]
+        assert d == d_ref
+        assert torch.equal(s, s_ref)
+        assert torch.equal(torch.as_tensor(r), torch.as_tensor(r_ref))
+        if d:
+            for env in envs:
+                env.reset(0)
+        else:
+            assert torch.equal(info[3], info_ref[3])
+
+
+def test_restore_continues_like_a_copy():
+    rng = np.random.RandomState(0)
+    env = Environment(make_graphs(2, 20), 'bss', verbose=False)
+    _, _, mask = env.reset(0)
+    for _ in range(3):
+        mask = env.step(random_actions(mask, rng)[0])[3][3]
+
+    token = env.snapshot()
+    branch = copy.deepcopy(env)
+    actions = []
+    for _ in range(5):
+        action = int(random_actions(mask, rng)[0])
+        s, r, done, info = env.step(action)
+        actions.append(action)
+        if done:
+            break
+        mask = info[3]
+
+    env.restore(token)
+    for action in actions:
+        s, r, done, _ = env.step(action)
+        s_ref, r_ref, done_ref, _ = branch.step(action)
+        assert done == done_ref
+        assert torch.equal(s, s_ref)
+        assert torch.equal(torch.as_tensor(r), torch.as_tensor(r_ref))
@@ -0,0 +1,62 @@
+"""
+`GATv2` on edge lists against dense matrices, on graphs zero padded to a
+larger size, and its edge term cache.
+"""
+import pytest
+import torch
+
+import models
+from utils.benchmark import make_graphs, batch_edges
+
+
+def make_model(n_nodes, edge_encoder='mlp', seed=0):
+    torch.manual_seed(seed)
+    model = models.GATv2(in_features=7, n_hidden=32, n_classes=1, n_nodes=n_nodes, n_heads=1, dropout=0.0,
+                         edge_encoder=edge_encoder, edge_cache_size=0)
+    return model.eval()
+
+
+@pytest.mark.parametrize('edge_encoder', ['mlp', 'dense'])
+def test_sparse_matches_dense(edge_encoder):
+    n_nodes = 20
+    graphs = list(make_graphs(4, n_nodes).values())
+    model = make_model(n_nodes, edge_encoder)
+    x = torch.rand(len(graphs), n_nodes, 7)
+    with torch.no_grad():
+        dense = model(x, torch.stack([g.W_weighted for g in graphs]).float())
+        sparse = model(x, batch_edges(graphs))
+    assert torch.allclose(dense, sparse, atol=1e-6)
+
+
+def test_padding_does_not_change_q():
+    n_nodes, size = 10, 16
+    graphs = list(make_graphs(2, n_nodes).values())
+    model = make_model(size)
+    x = torch.rand(len(graphs), n_nodes, 7)
+    adj = torch.stack([g.W_weighted for g in graphs]).float()
+    x_pad = torch.zeros(len(graphs), size, 7)
+    x_pad[:, :n_nodes] = x
+    adj_pad = torch.zeros(len(graphs), size, size)
+    adj_pad[:, :n_nodes, :n_nodes] = adj
+    node_mask = models.padding_mask([n_nodes] * len(graphs), size)
+    with torch.no_grad():
+        q = model(x, adj)
+        q_dense = model(x_pad, adj_pad, node_mask=node_mask)
+        q_sparse = model(x_pad, batch_edges(graphs), node_mask=node_mask)
+    for q_pad in (q_dense, q_sparse):
+        assert torch.allclose(q_pad[:, :n_nodes], q, atol=1e-6)
+        assert (q_pad[:, n_nodes:] == 0).all()
+
+
+def test_edge_cache_checks_the_graph():
+    n_nodes = 20
+    graphs = list(make_graphs(2, n_nodes).values())
+    model = make_model(n_nodes)
+    model.edge_cache = models.EdgeTermCache(8)
+    x = torch.rand(1, n_nodes, 7)
+    with torch.no_grad():
+        for g in graphs:
+            adj = g.W_weighted.unsqueeze(0).float()
+            # the same key for another graph must not reuse the terms of the first one
+            assert torch.equal(model(x, adj, graph_ids=[0]), model(x, adj))
+    assert model.edge_cache.cache_info()['misses'] == 2
@@ -0,0 +1,35 @@
+"""
+`BucketedReplayBuffer` on transitions of graphs of several sizes.
+"""
+import numpy as np
+
+from environment import Environment
+from graph import Graph
+from replay_buffer import BucketedReplayBuffer
+from utils.benchmark import make_graphs, random_actions
+
+
+def test_bucketed_buffer_keeps_sizes_apart():
+    sizes = (10, 20)
+    rng = np.random.RandomState(0)
+    buffer = BucketedReplayBuffer(64, 0.5, list(sizes), 7, Graph.max_edges(max(sizes), 5))
+    for n_nodes in sizes:
+        env = Environment(make_graphs(1, n_nodes), 'bss', verbose=False, sparse=True)
+        s, adj, mask = env.reset(0)
+        for _ in range(8):
+            s_, r, done, info = env.step(int(random_actions(mask, rng)[0]))
+            buffer.add(s, 0, r.item(), s_, adj, graph_id=n_nodes)
+            if done:
+                s, _, mask = env.reset(0)
+            else:
+                s, mask = s_, info[3]
+
+    assert [b.size for b in buffer.buckets] == [8, 8]
+    for _ in range(20):
+        batch = buffer.sample(4, beta=1)
+        n_nodes = batch['n_nodes'][0]
+        # one bucket per batch, padded to the bucket size only
+        assert (batch['n_nodes'] == n_nodes).all() and (batch['graph'] == n_nodes).all()
+        assert batch['obs'].shape[-1] == n_nodes
+        assert np.all(batch['weights'] > 0) and np.all(batch['weights'] <= 1)
+        assert np.all(batch['indexes'] // buffer.bucket_capacity == sizes.index(n_nodes))
@@ -0,0 +1,57 @@
+"""
+`SubprocVectorEnv` against a plain `Environment`, and a short
+`Runner.train_async` run on it.
+"""
+import os
+
+import numpy as np
+import torch
+
+import agent
+import runner
+from environment import Environment
+from vec_env import SubprocVectorEnv
+from utils.benchmark import make_graphs
+
+
+def test_vec_env_matches_environment():
+    graph_dict = make_graphs(4, 10)
+    vec_env = SubprocVectorEnv(graph_dict, 'bss', 2)
+    try:
+        envs = [Environment(graph_dict, 'bss', verbose=False) for _ in range(2)]
+        s, adj, mask = vec_env.reset()
+        graphs = vec_env.graphs().tolist()
+        for b, env in enumerate(envs):
+            s_ref, adj_ref, mask_ref = env.reset(graphs[b])
+            assert torch.equal(s[b], s_ref)
+            assert torch.equal(adj[b], adj_ref)
+        for _ in range(5):
+            actions = [int(np.flatnonzero(mask[b].numpy())[0]) for b in range(2)]
+            s, r, done, info = vec_env.step(actions)
+            mask = info['mask']
+            for b, env in enumerate(envs):
+                s_ref, r_ref, done_ref, _ = env.step(actions[b])
+                assert bool(done[b]) == done_ref
+                assert torch.equal(info['final_obs'][b] if done_ref else s[b], s_ref)
+                assert r[b].item() == r_ref.item()
+                if done_ref:
+                    env.reset(graphs[b])
+    finally:
+        vec_env.close()
+
+
+def test_train_async_runs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('rl_results')
+    torch.manual_seed(0)
+    dqn = agent.Agent('GATv2', 1e-3, 8, 100, 10, 7)
+    dqn.mem_capacity = 16 # learn once 16 transitions are stored
+    vec_env = SubprocVectorEnv(make_graphs(4, 10), 'bss', 2, n_episodes=2)
+    try:
+        reward_list, loss_list, epsilon_list = runner.Runner(None, dqn).train_async(vec_env, 4)
+    finally:
+        vec_env.close()
+    assert len(reward_list) == 4
+    assert loss_list and len(loss_list) == len(epsilon_list)
+    assert dqn.optimizer.param_groups[0]['lr'] == 1e-3 * 0.999 ** 2 # one decay per game of 2 episodes
+    assert len(os.listdir('rl_results')) == 2
@@ -0,0 +1,803 @@
+"""
+Micro-benchmarks and parity checks for the performance work on the
+environment, instance generation and the policy network.
+
+Run from the repository root, e.g. `python -m utils.benchmark batched_env`.
+"""
+import sys
+sys.path.append('../')
+
+import argparse
+import copy
+import pickle
+import random
+import time
+import types
+
+import numpy as np
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from graph import Graph, generate_graphs, sample_demands, demand_stats
+from environment import Environment, BatchedEnvironment, snapshot_dtype
+
+
+GRAPH_KWARGS = dict(penalty_cost_demand=5., penalty_cost_time=5., speed=30., time_limit=35.)
+
+
+def make_graphs(n_graphs, n_nodes, k_nn=5, n_vehicles=3, seed=0, workers=1):
+    """ Builds a dict of seeded instances with the default main.py parameters. """
+    return generate_graphs(n_graphs, base_seed=seed, workers=workers,
+                           n_nodes=n_nodes, k_nn=k_nn, n_vehicles=n_vehicles, **GRAPH_KWARGS)
+
+
+def random_actions(mask, rng):
+    """ Samples one feasible action per row of a `[B, n_nodes]` mask. """
+    scores = torch.as_tensor(rng.rand(*mask.shape)) * (mask != 0)
+    return scores.argmax(dim=1)
+
+
+def check_batched_parity(graph_dict, n_steps=2000, seed=0):
+    """ Steps `BatchedEnvironment` next to one `Environment` per instance and compares every output. """
+    rng = np.random.RandomState(seed)
+    graph_ids = list(graph_dict.keys())
+    envs = [Environment(graph_dict, 'bss', verbose=False) for _ in graph_ids]
+    batched = BatchedEnvironment(graph_dict, 'bss')
+
+    state, _, mask = batched.reset(graph_ids)
+    for env, g in zip(envs, graph_ids):
+        env.reset(g)
+
+    n_episodes = 0
+    for _ in range(n_steps):
+        actions = random_actions(mask, rng)
+        state, reward, done, mask = batched.step(actions)
+        for b, env in enumerate(envs):
+            s, r, d, info = env.step(actions[b])
+            assert d == bool(done[b])
+            assert torch.equal(r.reshape(()), reward[b]), (r, reward[b])
+            if d:
+                assert torch.equal(s, batched.final_state[b])
+                n_episodes += 1
+                s, _, m = env.reset(graph_ids[b])
+            else:
+                m = info[3]
+            assert torch.equal(s, state[b])
+            assert torch.equal(m[0].int(), mask[b])
+
+    return n_episodes
+
+
+def bench_batched_env(n_nodes=20, batch_size=256, n_steps=200, seed=0):
+    """ Steps per second of `BatchedEnvironment` against the single-instance `Environment`. """
+    rng = np.random.RandomState(seed)
+    graph_dict = make_graphs(batch_size, n_nodes)
+
+    n_episodes = check_batched_parity({g: graph_dict[g] for g in range(16)}, n_steps=300, seed=seed)
+    print("parity ok over {} finished episodes".format(n_episodes))
+
+    env = Environment(graph_dict, 'bss', verbose=False)
+    _, _, mask = env.reset(0)
+    start = time.perf_counter()
+    for i in range(n_steps * 10):
+        action = random_actions(mask, rng)
+        _, _, done, info = env.step(action)
+        mask = env.reset(i % batch_size)[2] if done else info[3]
+    single = n_steps * 10 / (time.perf_counter() - start)
+
+    batched = BatchedEnvironment(graph_dict, 'bss')
+    _, _, mask = batched.reset(list(range(batch_size)))
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        _, _, _, mask = batched.step(random_actions(mask, rng))
+    vectorized = n_steps * batch_size / (time.perf_counter() - start)
+
+    print("n_nodes={}, batch_size={}".format(n_nodes, batch_size))
+    print("  Environment:        {:>12.0f} steps/s".format(single))
+    print("  BatchedEnvironment: {:>12.0f} steps/s ({:.1f}x)".format(vectorized, vectorized / single))
+
+
+def record_actions(graph_dict, g, n_episodes, seed=0):
+    """ Plays `n_episodes` random episodes on graph `g` and returns the actions taken. """
+    rng = np.random.RandomState(seed)
+    env = Environment(graph_dict, 'bss', verbose=False)
+    actions = []
+    for _ in range(n_episodes):
+        _, _, mask = env.reset(g)
+        done = False
+        while not done:
+            action = int(random_actions(mask, rng)[0])
+            _, _, done, info = env.step(action)
+            mask = info[3]
+            actions.append(action)
+    return actions
+
+
+def replay_actions(env, g, actions):
+    """ Replays a recorded action trace, resetting whenever an episode ends. """
+    env.reset(g)
+    for action in actions:
+        done = env.step(action)[2]
+        if done:
+            env.reset(g)
+
+
+class AllocationCounter(TorchDispatchMode):
+    """ Counts the tensors allocated by torch ops, i.e. op outputs that do not reuse an input storage. """
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.nbytes = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        # sparse tensors have no storage of their own and are not counted
+        inputs = [a for a in list(args) + list(kwargs.values()) if isinstance(a, torch.Tensor) and a.layout == torch.strided]
+        input_ptrs = {a.untyped_storage().data_ptr() for a in inputs}
+        out = func(*args, **kwargs)
+        for o in (out if isinstance(out, (tuple, list)) else [out]):
+            if isinstance(o, torch.Tensor) and o.layout == torch.strided and o.untyped_storage().data_ptr() not in input_ptrs:
+                self.count += 1
+                self.nbytes += o.untyped_storage().nbytes()
+        return out
+
+
+def bench_env_alloc(sizes=(10, 20, 100), n_episodes=20):
+    """ Torch allocations and time per step of `Environment`, with and without `inplace`. """
+    for n_nodes in sizes:
+        graph_dict = make_graphs(1, n_nodes)
+        actions = record_actions(graph_dict, 0, n_episodes)
+        print("n_nodes={} ({} steps)".format(n_nodes, len(actions)))
+        for inplace in (False, True):
+            env = Environment(graph_dict, 'bss', verbose=False, inplace=inplace)
+            replay_actions(env, 0, actions[:1]) # allocate the buffers outside of the count
+            with AllocationCounter() as counter:
+                replay_actions(env, 0, actions)
+
+            start = time.perf_counter()
+            replay_actions(env, 0, actions)
+            elapsed = time.perf_counter() - start
+
+            print("  inplace={!s:5}  {:6.2f} allocs/step  {:8.1f} B/step  {:6.1f} us/step".format(
+                inplace, counter.count / len(actions), counter.nbytes / len(actions), 1e6 * elapsed / len(actions)))
+
+
+def bench_env_backends(sizes=(10, 20, 100), n_episodes=20):
+    """ Time per step of `Environment` with each transition backend. """
+    import env_backends
+    backends = ['numpy'] if env_backends.numba is None else ['numpy', 'numba']
+    for n_nodes in sizes:
+        graph_dict = make_graphs(1, n_nodes)
+        actions = record_actions(graph_dict, 0, n_episodes)
+        print("n_nodes={} ({} steps)".format(n_nodes, len(actions)))
+        for backend in backends:
+            env = Environment(graph_dict, 'bss', verbose=False, inplace=True, backend=backend)
+            replay_actions(env, 0, actions[:1]) # compile / warm up
+            start = time.perf_counter()
+            replay_actions(env, 0, actions)
+            elapsed = time.perf_counter() - start
+            print("  backend={:6} {:6.1f} us/step".format(backend, 1e6 * elapsed / len(actions)))
+
+
+def bench_snapshot(n_nodes=20, n_graphs=1000, n_rollouts=500, depth=5, seed=0):
+    """ Cost of `snapshot()`/`restore()` against `copy.deepcopy(env)` for lookahead rollouts. """
+    rng = np.random.RandomState(seed)
+    graph_dict = make_graphs(n_graphs, n_nodes)
+    env = Environment(graph_dict, 'bss', verbose=False)
+    _, _, mask = env.reset(0)
+    for _ in range(3):
+        _, _, _, info = env.step(random_actions(mask, rng)[0])
+        mask = info[3]
+
+    # a restored environment continues exactly like the original one
+    token = env.snapshot()
+    branch = copy.deepcopy(env)
+    for action in range(1, n_nodes):
+        if mask[0, action]:
+            break
+    expected = branch.step(action)
+    env.step(action)
+    env.restore(token)
+    result = env.step(action)
+    assert torch.equal(expected[0], result[0]) and torch.equal(expected[1], result[1])
+    env.restore(token)
+
+    snapshots = np.zeros(n_rollouts, dtype=snapshot_dtype(n_nodes))
+    start = time.perf_counter()
+    for i in range(n_rollouts):
+        env.snapshot(out=snapshots[i])
+        env.restore(snapshots[i])
+    fast = (time.perf_counter() - start) / n_rollouts
+
+    start = time.perf_counter()
+    copies = [copy.deepcopy(env) for _ in range(min(n_rollouts, 5))]
+    slow = (time.perf_counter() - start) / len(copies)
+
+    print("n_nodes={}, graph_dict of {} graphs".format(n_nodes, n_graphs))
+    print("  snapshot+restore: {:8.1f} us, {:9d} B per snapshot".format(1e6 * fast, snapshots.itemsize))
+    print("  copy.deepcopy:    {:8.1f} us, {:9d} B per copy".format(1e6 * slow, len(pickle.dumps(copies[0]))))
+
+
+def bench_vec_env(n_nodes=20, n_workers=4, n_steps=500, infer_ms=1., seed=0):
+    """ Steps per second of `SubprocVectorEnv`, stepping all envs at once and in two overlapped groups. """
+    from vec_env import SubprocVectorEnv
+    rng = np.random.RandomState(seed)
+    graph_dict = make_graphs(4 * n_workers, n_nodes)
+
+    def infer(mask):
+        # stands for the policy forward pass
+        time.sleep(infer_ms / 1000)
+        return random_actions(mask, rng)
+
+    env = Environment(graph_dict, 'bss', verbose=False)
+    _, _, mask = env.reset(0)
+    start = time.perf_counter()
+    for i in range(n_steps):
+        _, _, done, info = env.step(infer(mask))
+        mask = env.reset(i % len(graph_dict))[2] if done else info[3]
+    single = n_steps / (time.perf_counter() - start)
+
+    vec_env = SubprocVectorEnv(graph_dict, 'bss', n_workers=n_workers)
+    _, _, mask = vec_env.reset()
+    start = time.perf_counter()
+    for _ in range(n_steps // n_workers):
+        mask = vec_env.step(infer(mask))[3]['mask']
+    sync = n_steps // n_workers * n_workers / (time.perf_counter() - start)
+
+    groups = vec_env.split(2)
+    masks = [vec_env.reset(group)[2] for group in groups]
+    for group, mask in zip(groups, masks):
+        vec_env.step_async(infer(mask), group)
+    start = time.perf_counter()
+    for i in range(2 * (n_steps // n_workers)):
+        group = groups[i % 2]
+        mask = vec_env.step_wait(group)[3]['mask']
+        vec_env.step_async(infer(mask), group)
+    overlapped = 2 * (n_steps // n_workers) * (n_workers // 2) / (time.perf_counter() - start)
+    for group in groups:
+        vec_env.step_wait(group)
+    vec_env.close()
+
+    print("n_nodes={}, n_workers={}, {:.1f} ms per policy call".format(n_nodes, n_workers, infer_ms))
+    print("  Environment:                {:>10.0f} steps/s".format(single))
+    print("  SubprocVectorEnv.step:      {:>10.0f} steps/s".format(sync))
+    print("  step_async/step_wait x2:    {:>10.0f} steps/s".format(overlapped))
+
+
+def bench_graph_gen(n_graphs=200, n_nodes=20, workers=(1, 2, 4)):
+    """ Time to generate `n_graphs` instances with each number of workers, and checks they are identical. """
+    reference = None
+    for n in workers:
+        start = time.perf_counter()
+        graph_dict = make_graphs(n_graphs, n_nodes, workers=n)
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = graph_dict
+        for g in graph_dict:
+            assert np.array_equal(graph_dict[g].demands, reference[g].demands)
+            assert torch.equal(graph_dict[g].W_weighted, reference[g].W_weighted)
+            assert torch.equal(graph_dict[g].emb, reference[g].emb)
+        print("  workers={}  {:6.2f} s  ({:.1f} graphs/s)".format(n, elapsed, n_graphs / elapsed))
+
+
+def peak_rss_mb():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_lazy_store(n_graphs=2000, n_nodes=20, cache_size=64, n_episodes=5, seed=0):
+    """ Peak memory of training over `n_graphs` instances with a `LazyGraphStore` and with an eager graph_dict. """
+    from instances import LazyGraphStore
+    rng = np.random.RandomState(seed)
+    graph_kwargs = dict(n_nodes=n_nodes, k_nn=5, n_vehicles=3, **GRAPH_KWARGS)
+
+    def play(graph_dict):
+        env = Environment(graph_dict, 'bss', verbose=False)
+        for g in graph_dict:
+            for _ in range(n_episodes):
+                _, _, mask = env.reset(g)
+                done = False
+                while not done:
+                    _, _, done, info = env.step(random_actions(mask, rng)[0])
+                    mask = info[3]
+
+    # warm up imports and kernels, then lazy first as peak RSS only grows
+    play(LazyGraphStore(cache_size, base_seed=seed + 1, cache_size=cache_size, **graph_kwargs))
+    before = peak_rss_mb()
+    store = LazyGraphStore(n_graphs, base_seed=seed, cache_size=cache_size, **graph_kwargs)
+    start = time.perf_counter()
+    play(store)
+    lazy_time = time.perf_counter() - start
+    lazy_rss = peak_rss_mb() - before
+    assert torch.equal(store[n_graphs - 1].W_weighted, Graph(seed=(seed, n_graphs - 1), **graph_kwargs).W_weighted)
+    info = store.cache_info()
+
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    play(generate_graphs(n_graphs, base_seed=seed, **graph_kwargs))
+    eager_time = time.perf_counter() - start
+    eager_rss = peak_rss_mb() - before
+
+    print("n_graphs={}, n_nodes={}, {} episodes per graph".format(n_graphs, n_nodes, n_episodes))
+    print("  LazyGraphStore(cache_size={}): {:7.1f} s, +{:7.1f} MB peak RSS, {} hits, {} misses".format(
+        cache_size, lazy_time, lazy_rss, info['hits'], info['misses']))
+    print("  generate_graphs:               {:7.1f} s, +{:7.1f} MB peak RSS".format(eager_time, eager_rss))
+
+
+def bench_graph_props(n_graphs=200, sizes=(10, 20, 50), seed=0):
+    """
+    Construction time and traced Python/NumPy memory per `Graph`, with the
+    lazy properties left unbuilt and with all of them built.
+    """
+    import tracemalloc
+    for n_nodes in sizes:
+        graph_kwargs = dict(n_nodes=n_nodes, k_nn=5, n_vehicles=3, **GRAPH_KWARGS)
+        Graph(seed=(seed + 1, 0), **graph_kwargs).g # warm up
+
+        def build(trace):
+            if trace:
+                tracemalloc.start()
+            start = time.perf_counter()
+            graphs = [Graph(seed=(seed, i), **graph_kwargs) for i in range(n_graphs)]
+            lazy = time.perf_counter() - start, tracemalloc.get_traced_memory()[0]
+            for g in graphs:
+                g.emb, g.A, g.g, g.g_weighted
+            built = time.perf_counter() - start, tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            return lazy, built
+
+        (lazy_time, _), (built_time, _) = build(trace=False)
+        (_, lazy_mem), (_, built_mem) = build(trace=True)
+        lazy_time, built_time, lazy_mem, built_mem = (x / n_graphs for x in (lazy_time, built_time, lazy_mem, built_mem))
+
+        print("n_nodes={}".format(n_nodes))
+        print("  lazy:  {:7.2f} ms/graph, {:9.0f} B/graph".format(1e3 * lazy_time, lazy_mem))
+        print("  built: {:7.2f} ms/graph, {:9.0f} B/graph".format(1e3 * built_time, built_mem))
+
+
+def bench_demands(sizes=(20, 100, 500), batch_size=1000, max_demand=9, seed=0):
+    """ `sample_demands` against looping `Graph.get_demands`: time per batch and marginal statistics. """
+    for n_nodes in sizes:
+        rng = np.random.RandomState(seed)
+        # get_demands only reads these attributes
+        graph = types.SimpleNamespace(rng=rng, n_nodes=n_nodes, max_demand=max_demand)
+        start = time.perf_counter()
+        sequential = np.stack([Graph.get_demands(graph) for _ in range(batch_size)])
+        sequential_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched = sample_demands(rng, batch_size, n_nodes, max_demand)
+        batched_time = time.perf_counter() - start
+
+        a, b = demand_stats(sequential, max_demand), demand_stats(batched, max_demand)
+        assert b['zero_sum'] and not (batched[:, 1:] == 0).any() and np.abs(batched).max() <= max_demand
+        print("n_nodes={}, batch_size={}".format(n_nodes, batch_size))
+        print("  get_demands loop: {:8.1f} ms   mean {:+.3f} std {:.3f} |d| {:.3f} at bound {:.3f}".format(
+            1e3 * sequential_time, a['mean'], a['std'], a['abs_mean'], a['at_bound']))
+        print("  sample_demands:   {:8.1f} ms   mean {:+.3f} std {:.3f} |d| {:.3f} at bound {:.3f}".format(
+            1e3 * batched_time, b['mean'], b['std'], b['abs_mean'], b['at_bound']))
+        print("  total variation distance of the marginals: {:.4f}".format(0.5 * np.abs(a['pmf'] - b['pmf']).sum()))
+
+
+def bench_graph_build(sizes=(20, 100, 500, 1000), n_graphs=5, seed=0):
+    """ Construction time of large instances, and acceptance rate of the location sampler at a lower speed. """
+    for n_nodes in sizes:
+        graph_kwargs = dict(n_nodes=n_nodes, k_nn=5, n_vehicles=3, **GRAPH_KWARGS)
+        start = time.perf_counter()
+        graphs = [Graph(seed=(seed, i), **graph_kwargs) for i in range(n_graphs)]
+        build_time = (time.perf_counter() - start) / n_graphs
+
+        g = graphs[0]
+        start = time.perf_counter()
+        g.adjacenct_gen(n_nodes, g.num_neighbors, g.static)
+        adj_time = time.perf_counter() - start
+        print("n_nodes={:5d}  {:8.2f} ms/graph, {:8.2f} ms in adjacenct_gen".format(n_nodes, 1e3 * build_time, 1e3 * adj_time))
+
+    # at 12 km/h a station must be within 6 km of the depot
+    graph_kwargs = dict(GRAPH_KWARGS, speed=12.)
+    graphs = [Graph(seed=(seed, i), n_nodes=20, k_nn=5, n_vehicles=3, **graph_kwargs) for i in range(100)]
+    tries = sum(g.location_tries for g in graphs)
+    print("speed=12: acceptance rate {:.3f} ({} draws for {} graphs)".format(len(graphs) / tries, tries, len(graphs)))
+
+
+def bench_shared_instances(n_graphs=2000, n_nodes=20, n_workers=4):
+    """ Bytes sent to workers and `SubprocVectorEnv` start-up time, graph_dict against `SharedInstanceSet`. """
+    from instances import SharedInstanceSet
+    from vec_env import SubprocVectorEnv
+    graph_dict = make_graphs(n_graphs, n_nodes)
+    shared = SharedInstanceSet(graph_dict)
+
+    print("n_graphs={}, n_nodes={}, {} spawned workers".format(n_graphs, n_nodes, n_workers))
+    for name, instances in (('graph_dict', graph_dict), ('SharedInstanceSet', shared)):
+        start = time.perf_counter()
+        vec_env = SubprocVectorEnv(instances, 'bss', n_workers=n_workers, start_method='spawn')
+        vec_env.reset()
+        elapsed = time.perf_counter() - start
+        vec_env.close()
+        print("  {:18} {:10d} B pickled, start-up {:6.2f} s".format(name, len(pickle.dumps(instances)), elapsed))
+    print("  shared blocks: {} B".format(shared.nbytes()))
+    shared.close()
+
+
+def bench_instance_dataset(n_graphs=1000, n_nodes=20, n_lookups=1000, seed=0):
+    """ Size, open time and random access of an `InstanceDataset` against a pickled graph_dict. """
+    import os
+    import tempfile
+    from instances import InstanceDataset
+    graph_dict = make_graphs(n_graphs, n_nodes)
+    for g in graph_dict.values():
+        g.g, g.g_weighted # as pickled before graphs became lazy
+    rng = np.random.RandomState(seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pickle_path, path = os.path.join(tmp, 'graph_dic_val.pickle'), os.path.join(tmp, 'graph_dic_val')
+        with open(pickle_path, 'wb') as handle:
+            pickle.dump(graph_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        InstanceDataset.from_pickle(pickle_path, path)
+        dataset_bytes = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+        start = time.perf_counter()
+        with open(pickle_path, 'rb') as handle:
+            pickle.load(handle)
+        pickle_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        dataset = InstanceDataset(path)
+        open_time = time.perf_counter() - start
+
+        keys = rng.randint(n_graphs, size=n_lookups)
+        start = time.perf_counter()
+        for g in keys:
+            dataset[g]
+        lookup_time = (time.perf_counter() - start) / n_lookups
+
+        env, env_ref = Environment(dataset, 'bss', verbose=False), Environment(graph_dict, 'bss', verbose=False)
+        for g in keys[:20]:
+            s, _, mask = env.reset(g)
+            s_ref, _, mask_ref = env_ref.reset(g)
+            assert torch.equal(s, s_ref) and torch.equal(mask, mask_ref)
+
+        print("n_graphs={}, n_nodes={}".format(n_graphs, n_nodes))
+        print("  pickle:          {:10d} B, load {:8.1f} ms".format(os.path.getsize(pickle_path), 1e3 * pickle_time))
+        print("  InstanceDataset: {:10d} B, open {:8.1f} ms, {:.1f} us per random instance".format(
+            dataset_bytes, 1e3 * open_time, 1e6 * lookup_time))
+
+
+def batch_edges(graphs):
+    """ Pads the edge lists of `graphs` into a batched `(edge_index, edge_weight)` pair. """
+    n_edges = max(g.edge_index.shape[1] for g in graphs)
+    edge_index = torch.zeros(len(graphs), 2, n_edges, dtype=torch.long)
+    edge_weight = torch.zeros(len(graphs), n_edges)
+    for b, g in enumerate(graphs):
+        edge_index[b, :, :g.edge_index.shape[1]] = g.edge_index
+        edge_weight[b, :g.edge_index.shape[1]] = g.edge_weight
+    return edge_index, edge_weight
+
+
+def bench_sparse_gat(sizes=(20, 50, 100), batch_size=32, n_repeats=5, seed=0, edge_encoder='dense'):
+    """ Forward+backward time and bytes allocated by `GATv2` on dense matrices against edge lists. """
+    import models
+    torch.manual_seed(seed)
+    for n_nodes in sizes:
+        graphs = list(make_graphs(batch_size, n_nodes).values())
+        model = models.GATv2(in_features=7, n_hidden=128, n_classes=1, n_nodes=n_nodes, n_heads=1, dropout=0.0,
+                             edge_encoder=edge_encoder)
+        x = torch.rand(batch_size, n_nodes, 7)
+        inputs = {'dense': torch.stack([g.W_weighted for g in graphs]).float(), 'sparse': batch_edges(graphs)}
+
+        outputs = {}
+        print("n_nodes={}, batch_size={}, {} edges per graph".format(n_nodes, batch_size, inputs['sparse'][0].shape[2]))
+        for name, adj in inputs.items():
+            with AllocationCounter() as counter:
+                q = model(x, adj)
+                q.sum().backward()
+            start = time.perf_counter()
+            for _ in range(n_repeats):
+                model(x, adj).sum().backward()
+            elapsed = (time.perf_counter() - start) / n_repeats
+            outputs[name] = q.detach()
+            print("  {:6} {:8.1f} ms, {:8.1f} MB allocated".format(name, 1e3 * elapsed, counter.nbytes / 2 ** 20))
+        print("  max |dense - sparse| = {:.2e}".format((outputs['dense'] - outputs['sparse']).abs().max()))
+
+
+def bench_edge_encoder(sizes=(20, 50, 100, 200), batch_size=32, n_repeats=5, seed=0):
+    """
+    Parameters and forward+backward time of `GATv2` with the dense
+    `lin_n_node` edge encoder against the per-edge MLP on edge lists,
+    then one MLP model applied to every size.
+    """
+    import models
+    torch.manual_seed(seed)
+    shared = models.GATv2(in_features=7, n_hidden=128, n_classes=1, n_nodes=sizes[0], n_heads=1, dropout=0.0)
+    for n_nodes in sizes:
+        graphs = list(make_graphs(batch_size, n_nodes).values())
+        x = torch.rand(batch_size, n_nodes, 7)
+        print("n_nodes={}, batch_size={}".format(n_nodes, batch_size))
+        for name in ('dense', 'mlp'):
+            if name == 'dense' and n_nodes ** 4 > 2 ** 28:
+                print("  {:6} skipped, lin_n_node would have {:.1e} weights".format(name, n_nodes ** 4))
+                continue
+            model = models.GATv2(in_features=7, n_hidden=128, n_classes=1, n_nodes=n_nodes, n_heads=1, dropout=0.0,
+                                 edge_encoder=name)
+            adj = batch_edges(graphs)
+            model(x, adj).sum().backward()
+            start = time.perf_counter()
+            for _ in range(n_repeats):
+                model(x, adj).sum().backward()
+            elapsed = (time.perf_counter() - start) / n_repeats
+            n_params = sum(p.numel() for p in model.parameters())
+            print("  {:6} {:10d} parameters, {:8.1f} ms".format(name, n_params, 1e3 * elapsed))
+        with torch.no_grad():
+            q = shared(x, batch_edges(graphs))
+        print("  model built for {} nodes: output {}".format(sizes[0], tuple(q.shape)))
+
+
+def bench_edge_cache(sizes=(20, 50, 100), batch_size=32, n_graphs=64, n_repeats=20, seed=0):
+    """
+    Time of the learner forwards (policy, policy and target on a batch)
+    and of single-state forwards, computing the edge terms of every
+    graph against reusing the ones cached per graph key.
+    """
+    import models
+    torch.manual_seed(seed)
+    rng = np.random.RandomState(seed)
+    for n_nodes in sizes:
+        graphs = list(make_graphs(n_graphs, n_nodes).values())
+        print("n_nodes={}, batch_size={}, {} graphs".format(n_nodes, batch_size, n_graphs))
+        for name in ('dense', 'sparse'):
+            model = models.GATv2(in_features=7, n_hidden=128, n_classes=1, n_nodes=n_nodes, n_heads=1, dropout=0.0,
+                                 edge_cache_size=n_graphs)
+            batches = [rng.choice(n_graphs, batch_size) for _ in range(n_repeats)]
+            x = torch.rand(batch_size, n_nodes, 7)
+            if name == 'dense':
+                adj = lambda ids: torch.stack([graphs[g].W_weighted for g in ids]).float()
+            else:
+                adj = lambda ids: batch_edges([graphs[g] for g in ids])
+            inputs = [(adj(ids), ids) for ids in batches]
+            single = [(adj([g]), [g]) for g in rng.choice(n_graphs, n_repeats * batch_size)]
+
+            times = {}
+            for cached in (False, True):
+                model.edge_cache.clear()
+                with torch.no_grad():
+                    start = time.perf_counter()
+                    for a, ids in inputs:
+                        for _ in range(3):
+                            model(x, a, graph_ids=ids if cached else None)
+                    learner = (time.perf_counter() - start) / n_repeats
+                    start = time.perf_counter()
+                    for a, ids in single:
+                        model(x[:1], a, graph_ids=ids if cached else None)
+                    act = (time.perf_counter() - start) / len(single)
+                times[cached] = (learner, act)
+            info = model.edge_cache.cache_info()
+            print("  {:6} learner {:7.2f} -> {:7.2f} ms, choose_action {:6.3f} -> {:6.3f} ms, hit rate {:.1%}".format(
+                name, 1e3 * times[False][0], 1e3 * times[True][0], 1e3 * times[False][1], 1e3 * times[True][1], info['hit_rate']))
+
+
+def bench_encdec(sizes=(10, 20, 50, 100, 200, 500), n_steps=50, seed=0):
+    """
+    Per-step latency of `DQAgent.choose_action` with the full `GATv2`
+    forward against `GATv2_encdec`, which encodes the graph once per
+    episode and only runs the decoder at each step.
+    """
+    from agent import DQAgent
+    torch.manual_seed(seed)
+    rng = np.random.RandomState(seed)
+    for n_nodes in sizes:
+        graph_dict = make_graphs(1, n_nodes)
+        env = Environment(graph_dict, 'bss', verbose=False)
+        s, adj, mask = env.reset(0)
+        states = []
+        while len(states) < n_steps:
+            states.append((s.clone(), mask.clone()))
+            s, _, done, info = env.step(int(random_actions(mask, rng)[0]))
+            mask = env.reset(0)[2] if done else info[3]
+
+        print("n_nodes={}, {} steps".format(n_nodes, n_steps))
+        for model in ('GATv2', 'GATv2_encdec'):
+            # edge list replay buffer, a dense one would take capacity * n_nodes**2 floats
+            agent = DQAgent(model, 1e-4, 32, 100, n_nodes, 7, max_edges=Graph.max_edges(n_nodes, 5))
+            agent.epsilon_ = 0
+            graph_id = 0 if model == 'GATv2_encdec' else None
+            start = time.perf_counter()
+            agent.choose_action(states[0][0], adj, states[0][1], graph_id=graph_id)
+            first = time.perf_counter() - start
+            times = []
+            for s, mask in states:
+                start = time.perf_counter()
+                agent.choose_action(s, adj, mask, graph_id=graph_id)
+                times.append(time.perf_counter() - start)
+            print("  {:13} p50 {:8.3f} ms, p99 {:8.3f} ms, first step {:8.3f} ms".format(
+                model, 1e3 * np.percentile(times, 50), 1e3 * np.percentile(times, 99), 1e3 * first))
+
+
+def bench_mixed_sizes(sizes=(10, 20, 50, 100, 200), n_transitions=64, batch_size=32, n_updates=20, seed=0):
+    """
+    Learner steps on transitions of graphs of several sizes, stored in a
+    `BucketedReplayBuffer` with one bucket per size against a single bucket
+    that pads every graph to the largest size. Reports the batch
+    utilization (real nodes over padded nodes) and the time per update.
+    """
+    from agent import DQAgent
+    rng = np.random.RandomState(seed)
+    transitions = []
+    for n_nodes in sizes:
+        graph_dict = make_graphs(1, n_nodes, seed=seed)
+        env = Environment(graph_dict, 'bss', verbose=False, sparse=True)
+        s, adj, mask = env.reset(0)
+        for _ in range(n_transitions):
+            a = int(random_actions(mask, rng)[0])
+            s_, r, done, info = env.step(a)
+            transitions.append((s, a, r.item(), s_, adj, n_nodes))
+            if done:
+                s, _, mask = env.reset(0)
+            else:
+                s, mask = s_, info[3]
+
+    for buckets in (list(sizes), [max(sizes)]):
+        torch.manual_seed(seed)
+        random.seed(seed)
+        agent = DQAgent('GATv2', 1e-4, batch_size, 100, max(sizes), 7, max_edges=Graph.max_edges(max(sizes), 5), node_buckets=buckets)
+        for s, a, r, s_, adj, g in transitions:
+            agent.replay_buffer.add(s, a, r, s_, adj, graph_id=g)
+        agent.learn(0) # warm up
+        real = padded = 0
+        start = time.perf_counter()
+        for i in range(n_updates):
+            agent.learn(i)
+        elapsed = time.perf_counter() - start
+        for _ in range(100):
+            batch = agent.replay_buffer.sample(batch_size, beta=1)
+            real += batch['n_nodes'].sum()
+            padded += batch_size * batch['obs'].shape[-1]
+        print("buckets {:22} utilization {:5.1%}, {:7.1f} ms per update".format(
+            str(buckets), real / padded, 1e3 * elapsed / n_updates))
+
+
+def unfused_learn(agent, iter_count):
+    """ `DQAgent.learn` before the fused step: a second policy forward for the double-DQN action and `retain_graph=True`. """
+    if agent.learn_step_counter % agent.target_net_replace_freq == 0:
+        agent.target_net.load_state_dict(agent.policy_net.state_dict())
+    agent.learn_step_counter += 1
+    t = agent.replay_buffer.sample(agent.batch_size, beta=agent.prioritized_replay_beta(iter_count))
+    b_s = torch.tensor(t['obs']).permute(0, 2, 1).float()
+    b_s_ = torch.tensor(t['next_obs']).permute(0, 2, 1).float()
+    b_a = torch.tensor(t['action']).reshape(-1, 1, 1)
+    b_r = torch.clamp(torch.tensor(t['reward']).reshape(-1, 1, 1), min=-1, max=1)
+    b_adj = torch.tensor(t['adj']).float()
+    b_weight = torch.tensor(t['weights']).reshape(-1, 1, 1).float()
+    q_eval = agent.policy_net(b_s, b_adj, graph_ids=t['graph']).gather(1, b_a)
+    with torch.no_grad():
+        best_a = agent.policy_net(b_s, b_adj, graph_ids=t['graph']).argmax(1).unsqueeze(-1)
+        q_target = b_r + agent.gamma * agent.target_net(b_s_, b_adj, graph_ids=t['graph']).gather(1, best_a)
+    loss = torch.clamp(torch.mean(b_weight * agent.criterion(q_eval, q_target)), min=-1, max=1)
+    agent.replay_buffer.update_priorities(t['indexes'], np.abs((q_eval - q_target).detach().numpy()).reshape(-1) + 1e-6)
+    agent.optimizer.zero_grad()
+    loss.backward(retain_graph=True)
+    agent.optimizer.step()
+    if agent.epsilon_ > agent.epsilon_min:
+        agent.epsilon_ *= agent.discount_factor
+    return loss, agent.epsilon_
+
+
+def run_learner(fused, n_nodes, batch_size, n_updates, seed):
+    """ Times `n_updates` learner steps in a fresh process, returns (updates/s, peak RSS growth in MB, losses). """
+    from agent import DQAgent
+    torch.manual_seed(seed)
+    random.seed(seed)
+    rng = np.random.RandomState(seed)
+    graph_dict = make_graphs(8, n_nodes, seed=seed)
+    env = Environment(graph_dict, 'bss', verbose=False)
+    agent = DQAgent('GATv2', 1e-4, batch_size, 100, n_nodes, 7)
+    for g in range(len(graph_dict)):
+        s, adj, mask = env.reset(g)
+        done = False
+        while not done:
+            a = int(random_actions(mask, rng)[0])
+            s_, r, done, info = env.step(a)
+            agent.replay_buffer.add(s, a, r.item(), s_, adj, graph_id=g)
+            s, mask = s_, info[3]
+    learn = agent.learn if fused else (lambda i: unfused_learn(agent, i))
+
+    losses = [learn(0)[0].item()] # warm up
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    for i in range(n_updates):
+        loss, _ = learn(i)
+        losses.append(loss.item())
+    return n_updates / (time.perf_counter() - start), peak_rss_mb() - before, losses
+
+
+def bench_learner(sizes=(20, 50, 100), batch_size=32, n_updates=30, seed=0):
+    """
+    Learner updates per second and peak memory of `DQAgent.learn`, which
+    reuses one policy forward for q_eval and the double-DQN action and
+    frees the graph in backward, against the previous step (two policy
+    forwards, `retain_graph=True`). Each variant runs in its own process
+    so that peak RSS is not shared; the losses must match.
+    """
+    import multiprocessing as mp
+    ctx = mp.get_context('spawn')
+    for n_nodes in sizes:
+        print("n_nodes={}, batch_size={}, {} updates".format(n_nodes, batch_size, n_updates))
+        results = {}
+        for fused in (False, True):
+            with ctx.Pool(1) as pool:
+                results[fused] = pool.apply(run_learner, (fused, n_nodes, batch_size, n_updates, seed))
+            updates_s, peak_mb, _ = results[fused]
+            print("  {:8} {:7.1f} updates/s, +{:7.1f} MB peak RSS".format('fused' if fused else 'unfused', updates_s, peak_mb))
+        print("  max |loss difference| {:.2e}".format(np.abs(np.subtract(results[False][2], results[True][2])).max()))
+
+
+def bench_choose_actions(n_nodes=20, batch_sizes=(8, 64, 256), n_repeats=5, seed=0):
+    """
+    Greedy actions for a batch of environments with `DQAgent.choose_actions`
+    (one forward) against a loop of `choose_action`, which the batched
+    actions must match row by row.
+    """
+    from agent import DQAgent
+    torch.manual_seed(seed)
+    rng = np.random.RandomState(seed)
+    graph_dict = make_graphs(16, n_nodes, seed=seed)
+    env = Environment(graph_dict, 'bss', verbose=False)
+    agent = DQAgent('GATv2', 1e-4, 32, 100, n_nodes, 7, max_edges=0)
+    agent.epsilon_ = 0
+    for batch_size in batch_sizes:
+        states, adjs, masks, graph_ids = [], [], [], []
+        for b in range(batch_size):
+            g = b % len(graph_dict)
+            s, adj, mask = env.reset(g)
+            for _ in range(rng.randint(0, n_nodes // 2)):
+                s, _, done, info = env.step(int(random_actions(mask, rng)[0]))
+                mask = info[3]
+                if done:
+                    s, adj, mask = env.reset(g)
+            states.append(s); adjs.append(adj); masks.append(mask); graph_ids.append(g)
+        states, adj, mask = torch.stack(states), torch.stack(adjs), torch.cat(masks)
+
+        def loop():
+            return torch.cat([agent.choose_action(states[b], adj[b], mask[b:b+1], graph_id=graph_ids[b])[0] for b in range(batch_size)])
+
+        def batched():
+            return agent.choose_actions(states, adj, mask, graph_ids=graph_ids)
+
+        assert torch.equal(loop(), batched())
+        print("n_nodes={}, batch of {} envs".format(n_nodes, batch_size))
+        for name, fn in (('loop', loop), ('batched', batched)):
+            start = time.perf_counter()
+            for _ in range(n_repeats):
+                fn()
+            elapsed = (time.perf_counter() - start) / n_repeats
+            print("  {:8} {:8.2f} ms per batch, {:8.0f} decisions/s".format(name, 1e3 * elapsed, batch_size / elapsed))
+
+
+BENCHMARKS = {
+    'batched_env': bench_batched_env,
+    'choose_actions': bench_choose_actions,
+    'env_alloc': bench_env_alloc,
+    'demands': bench_demands,
+    'edge_cache': bench_edge_cache,
+    'edge_encoder': bench_edge_encoder,
+    'encdec': bench_encdec,
+    'env_backends': bench_env_backends,
+    'graph_build': bench_graph_build,
+    'graph_gen': bench_graph_gen,
+    'graph_props': bench_graph_props,
+    'instance_dataset': bench_instance_dataset,
+    'lazy_store': bench_lazy_store,
+    'learner': bench_learner,
+    'mixed_sizes': bench_mixed_sizes,
+    'shared_instances': bench_shared_instances,
+    'snapshot': bench_snapshot,
+    'sparse_gat': bench_sparse_gat,
+    'vec_env': bench_vec_env,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Performance benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark]()
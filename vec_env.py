@@ -0,0 +1,216 @@
+import multiprocessing as mp
+import numpy as np
+import torch
+
+from environment import Environment
+
+"""
+Runs several `Environment` instances in worker processes.
+
+Each worker owns a slice of `graph_dict` and one `Environment` over it.
+Actions, observations, masks, rewards and done flags are exchanged
+through shared memory; the pipes only carry the command and the ring
+slot to write, so no tensor is pickled while stepping.
+"""
+
+
+def _ring_fields(n_envs, n_features, n_nodes, depth):
+    """ Shape and dtype of every shared array; results have `depth` slots per env. """
+    return {
+        'action': ((n_envs,), np.int64),
+        'obs': ((depth, n_envs, n_features, n_nodes), np.float32),
+        'final_obs': ((depth, n_envs, n_features, n_nodes), np.float32), # last obs of a finished episode
+        'mask': ((depth, n_envs, n_nodes), np.int32),
+        'reward': ((depth, n_envs), np.float32),
+        'done': ((depth, n_envs), np.bool_),
+        'graph': ((depth, n_envs), np.int64), # graph key after auto-reset
+    }
+
+
+def _as_arrays(buffers, fields):
+    return {k: np.frombuffer(buffers[k], dtype=dtype).reshape(shape) for k, (shape, dtype) in fields.items()}
+
+
+def _worker(remote, index, graph_dict, name, env_kwargs, buffers, fields, n_episodes):
+    """ Worker loop: waits for a command and writes its results into ring slot `slot`. """
+    ring = _as_arrays(buffers, fields)
+    env = Environment(graph_dict, name, **env_kwargs)
+    graph_ids = list(graph_dict)
+    game, episode = 0, 0
+
+    def write(slot, s, mask, reward, done):
+        ring['obs'][slot, index] = s.numpy()
+        ring['mask'][slot, index] = mask[0].numpy()
+        ring['reward'][slot, index] = reward
+        ring['done'][slot, index] = done
+        ring['graph'][slot, index] = graph_ids[game]
+
+    try:
+        while True:
+            cmd, slot = remote.recv()
+            if cmd == 'step':
+                s, r, done, info = env.step(int(ring['action'][index]))
+                if done:
+                    # start the next episode right away, moving to the next graph every n_episodes
+                    ring['final_obs'][slot, index] = s.numpy()
+                    episode += 1
+                    if episode == n_episodes:
+                        game, episode = (game + 1) % len(graph_ids), 0
+                    s, _, mask = env.reset(graph_ids[game])
+                else:
+                    mask = info[3]
+                write(slot, s, mask, r.item(), done)
+            elif cmd == 'reset':
+                s, _, mask = env.reset(graph_ids[game])
+                write(slot, s, mask, 0., False)
+            elif cmd == 'close':
+                break
+            remote.send(None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        remote.close()
+
+
+class SubprocVectorEnv:
+    """
+    `n_workers` environments stepped in parallel processes.
+
+    Graph keys are dealt round-robin to the workers. A worker plays
+    `n_episodes` episodes on a graph before moving to the next one of its
+    slice, and resets by itself when an episode ends: the terminal
+    observation is then in `info['final_obs']` and the observation is the
+    first one of the new episode.
+
+    Results are written into a ring of `depth` slots per env and returned
+    as tensors sharing its memory, so they stay valid until the same env
+    has been stepped `depth` more times.
+    """
+
+    def __init__(self, graph_dict, name, n_workers, n_episodes=1, depth=2, start_method=None, **env_kwargs):
+        self.graph_dict = graph_dict
+        self.n_envs = n_workers
+        self.n_episodes = n_episodes
+        self.depth = depth
+
+        graph = next(iter(graph_dict.values()))
+        self.n_nodes = graph.n_nodes
+        env_kwargs.setdefault('verbose', False)
+        env = Environment({0: graph}, name, **env_kwargs)
+        n_features = env.reset(0)[0].shape[0]
+
+        ctx = mp.get_context(start_method)
+        self.fields = _ring_fields(self.n_envs, n_features, self.n_nodes, depth)
+        buffers = {k: ctx.RawArray('b', int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                   for k, (shape, dtype) in self.fields.items()}
+        self.ring = _as_arrays(buffers, self.fields)
+        self.slot = np.zeros(self.n_envs, dtype=np.int64) # next slot to write, per env
+        self.last_slot = np.zeros(self.n_envs, dtype=np.int64) # slot of the latest results, per env
+        # adjacency of the graph in each slot, copied only when the graph of the env changes
+        self.adj_ring = torch.zeros((depth, self.n_envs, self.n_nodes, self.n_nodes), dtype=graph.W_weighted.dtype)
+        self.adj_key = np.full((depth, self.n_envs), -1, dtype=np.int64)
+
+        keys = list(graph_dict)
+        self.remotes, self.processes = [], []
+        for i in range(self.n_envs):
+            local, remote = ctx.Pipe()
+            if hasattr(graph_dict, 'subset'):
+                graphs = graph_dict.subset(keys[i::self.n_envs]) # lazy stores build their graphs in the worker
+            else:
+                graphs = {g: graph_dict[g] for g in keys[i::self.n_envs]}
+            process = ctx.Process(target=_worker, daemon=True,
+                                  args=(remote, i, graphs, name, env_kwargs, buffers, self.fields, n_episodes))
+            process.start()
+            remote.close()
+            self.remotes.append(local)
+            self.processes.append(process)
+        self.closed = False
+
+    def split(self, n_groups):
+        """ Splits the envs into `n_groups` contiguous groups, e.g. to step one while acting on another. """
+        bounds = np.linspace(0, self.n_envs, n_groups + 1).astype(int)
+        return [slice(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+    def _ids(self, env_ids):
+        if env_ids is None:
+            env_ids = slice(0, self.n_envs)
+        if isinstance(env_ids, slice):
+            return env_ids, range(self.n_envs)[env_ids]
+        env_ids = np.asarray(env_ids)
+        return env_ids, env_ids
+
+    def _send(self, cmd, env_ids):
+        for i in env_ids:
+            self.remotes[i].send((cmd, int(self.slot[i])))
+            self.last_slot[i] = self.slot[i]
+            self.slot[i] = (self.slot[i] + 1) % self.depth
+
+    def _wait(self, env_ids):
+        for i in env_ids:
+            self.remotes[i].recv()
+
+    def _read(self, key, index, ids):
+        """ Results of envs `index`, a view of the ring when they all sit in the same slot. """
+        slots = self.last_slot[ids]
+        if isinstance(index, slice) and (slots == slots[0]).all():
+            return torch.from_numpy(self.ring[key][slots[0], index])
+        return torch.from_numpy(self.ring[key][slots, ids])
+
+    def _read_adj(self, index, ids, graphs):
+        """ Adjacency of the graphs `graphs` of envs `index`, kept in the ring like the other results. """
+        slots = self.last_slot[ids]
+        for slot, i, g in zip(slots, ids, graphs.tolist()):
+            if self.adj_key[slot, i] != g:
+                self.adj_ring[slot, i] = self.graph_dict[g].W_weighted
+                self.adj_key[slot, i] = g
+        if isinstance(index, slice) and (slots == slots[0]).all():
+            return self.adj_ring[slots[0], index]
+        return self.adj_ring[slots, ids]
+
+    def graphs(self, env_ids=None):
+        """ Keys of the graphs the envs are currently playing. """
+        index, ids = self._ids(env_ids)
+        return self._read('graph', index, ids)
+
+    def reset(self, env_ids=None):
+        """ Resets the envs to their current graph; returns `(obs, adj, mask)`. """
+        index, ids = self._ids(env_ids)
+        self._send('reset', ids)
+        self._wait(ids)
+        graphs = self._read('graph', index, ids)
+        return self._read('obs', index, ids), self._read_adj(index, ids, graphs), self._read('mask', index, ids)
+
+    def step_async(self, actions, env_ids=None):
+        """ Sends one action per env in `env_ids` and returns without waiting for the workers. """
+        index, ids = self._ids(env_ids)
+        self.ring['action'][index] = np.asarray(actions).reshape(-1)
+        self._send('step', ids)
+
+    def step_wait(self, env_ids=None):
+        """ Waits for the envs stepped by `step_async`; returns `(obs, reward, done, info)`. """
+        index, ids = self._ids(env_ids)
+        self._wait(ids)
+        graphs = self._read('graph', index, ids)
+        done = self._read('done', index, ids)
+        info = {'mask': self._read('mask', index, ids),
+                'final_obs': self._read('final_obs', index, ids),
+                'graph': graphs,
+                'adj': self._read_adj(index, ids, graphs)}
+        return self._read('obs', index, ids), self._read('reward', index, ids), done, info
+
+    def step(self, actions, env_ids=None):
+        self.step_async(actions, env_ids)
+        return self.step_wait(env_ids)
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+    def __del__(self):
+        if not getattr(self, 'closed', True):
+            self.close()